@@ -1,76 +1,240 @@
 #!/usr/bin/env python
-import faust
-import random
-import datetime
+import asyncio
+import logging
+import os
 
-# Khởi tạo ứng dụng Faust
-app = faust.App('weather-stream', broker='kafka://localhost:9092')
+# Dùng uvloop cho event loop (phải đặt trước khi import faust);
+# vẫn có thể ghi đè bằng tùy chọn --loop hoặc biến môi trường F_LOOP
+if not os.environ.get('F_LOOP'):
+    os.environ.setdefault('FAUST_LOOP', 'uvloop')
+
+import faust  # noqa: E402
+import time
+
+import msgpack
+import numpy as np
+import orjson
+from faust.serializers import codecs
+
+try:
+    from numba import njit
+except ImportError:  # numba là tùy chọn
+    njit = None
+
+
+# Codec MessagePack: nhỏ gọn và nhanh hơn JSON cho bản ghi số
+class raw_msgpack(codecs.Codec):
+
+    def _dumps(self, obj):
+        return msgpack.packb(obj, use_bin_type=True)
+
+    def _loads(self, s):
+        return msgpack.unpackb(s, raw=False)
+
+
+codecs.register('msgpack', raw_msgpack())
+
+logger = logging.getLogger(__name__)
+
+# Mẫu log cho mỗi bản ghi nhận được, định dạng trễ bởi logging
+RECEIVED_FMT = ('Received data - City: %s, Temperature: %.2f°C, '
+                'Humidity: %.2f%%, Wind Speed: %.2f m/s, Timestamp: %s')
+
+# Danh sách thành phố cố định, không cần tạo lại mỗi lần timer chạy
+CITIES = ('Hanoi', 'HoChiMinhCity', 'Danang')
 
-# Định nghĩa kiểu dữ liệu WeatherData
-class WeatherData(faust.Record, serializer='json'):
+# Chỉ số của từng thành phố trong các mảng tổng hợp
+CITY_INDEX = {city: i for i, city in enumerate(CITIES)}
+
+_time_ns = time.time_ns
+
+# Bộ sinh số ngẫu nhiên và khoảng giá trị (nhiệt độ, độ ẩm, tốc độ gió)
+_rng = np.random.default_rng()
+_low = np.array([20.0, 50.0, 0.0])
+_high = np.array([40.0, 100.0, 15.0])
+
+# Khởi tạo ứng dụng Faust
+app = faust.App(
+    'weather-stream',
+    broker='kafka://localhost:9092',
+    value_serializer='msgpack',
+    # Gom các bản ghi thành lô lớn trước khi gửi tới broker
+    producer_linger=0.1,
+    producer_max_batch_size=64000,
+    producer_acks=1,
+    # Nén LZ4 cho mọi bản ghi gửi đi (gồm cả changelog của bảng)
+    producer_compression_type='lz4',
+    # Lấy nhiều bản ghi hơn cho mỗi lần fetch từ broker
+    broker_max_poll_records=500,
+    consumer_max_fetch_size=1048576,
+    broker_session_timeout=30.0,
+    broker_heartbeat_interval=3.0,
+    stream_buffer_maxsize=16384,
+    # Đủ partition để nhiều worker (tiến trình) chạy song song theo thành phố
+    topic_partitions=4,
+)
+
+# Định nghĩa kiểu dữ liệu WeatherData (không kèm metadata "__faust"
+# trong payload vì topic đã khai báo value_type)
+class WeatherData(faust.Record,
+                  serializer='msgpack',
+                  include_metadata=False,
+                  isodates=False,
+                  polymorphic_fields=False):
     city: str
     temperature: float
     humidity: float
     wind_speed: float
-    timestamp: str
+    timestamp: int  # nano giây kể từ epoch
 
 # Tạo topic Kafka
-weather_topic = app.topic('weather', value_type=WeatherData)
-
-# Bảng lưu tổng nhiệt độ và số lần cập nhật để tính trung bình chính xác
-temperature_sums = app.Table('temperature_sums', default=float)
-temperature_counts = app.Table('temperature_counts', default=int)
-average_temperatures = app.Table('average_temperatures', default=float)
-
-# Bảng lưu trữ dữ liệu thời tiết mới nhất theo thành phố
-latest_weather = app.Table('latest_weather', default=dict)
-
-# Logic xử lý dữ liệu thời tiết
-@app.agent(weather_topic)
+weather_topic = app.topic(
+    'weather',
+    key_type=str,
+    # Cùng serializer với key của bảng temperature_state (json) để key
+    # thành phố được chia partition giống nhau ở cả hai topic
+    key_serializer='json',
+    value_type=WeatherData,
+    config={'compression.type': 'lz4'},
+)
+
+# Bảng lưu (tổng nhiệt độ, số lần cập nhật) theo từng thành phố để tính
+# trung bình chính xác. use_partitioner=True: bản ghi changelog được chia
+# partition theo key (thành phố) giống topic weather, nên mỗi thành phố
+# luôn được ghi và khôi phục trên cùng partition với dữ liệu nguồn
+temperature_state = app.Table(
+    'temperature_state', default=tuple, use_partitioner=True)
+
+# Dữ liệu thời tiết mới nhất theo thành phố: có thể dựng lại từ topic,
+# nên giữ trong bộ nhớ thay vì dùng bảng có changelog. Đây là dict riêng
+# của từng tiến trình: mỗi worker chỉ thấy các thành phố thuộc partition
+# được gán cho nó
+latest_weather = {}
+
+if njit is not None:
+
+    # Nhân tổng hợp được biên dịch sang mã máy, dùng khi số thành phố lớn
+    @njit(cache=True)
+    def aggregate_temperatures(sums, counts, indices, temperatures):
+        for j in range(indices.shape[0]):
+            i = indices[j]
+            sums[i] += temperatures[j]
+            counts[i] += 1
+
+else:
+
+    def aggregate_temperatures(sums, counts, indices, temperatures):
+        size = sums.shape[0]
+        sums += np.bincount(indices, weights=temperatures, minlength=size)
+        counts += np.bincount(indices, minlength=size)
+
+
+# Biên dịch trước để bản ghi đầu tiên không phải chờ
+aggregate_temperatures(
+    np.zeros(1, dtype=np.float64),
+    np.zeros(1, dtype=np.int64),
+    np.zeros(1, dtype=np.int64),
+    np.zeros(1, dtype=np.float64),
+)
+
+# Logic xử lý dữ liệu thời tiết. Agent ghi vào bảng nên phải dùng
+# concurrency=1 (Faust không hỗ trợ ghi bảng khi concurrency > 1); xử lý
+# song song đạt được nhờ các partition của topic và chạy thêm worker
+@app.agent(weather_topic, concurrency=1)
 async def process_weather(stream):
-    async for weather_data in stream:
-        city = weather_data.city
-
-        # Cập nhật dữ liệu mới nhất
-        latest_weather[city] = weather_data.asdict()
-
-        # Cập nhật tổng nhiệt độ và số lần nhận dữ liệu
-        temperature_sums[city] += weather_data.temperature
-        temperature_counts[city] += 1
+    # Xử lý theo lô: tối đa 500 bản ghi hoặc sau 1 giây
+    async for batch in stream.take(500, within=1.0):
+        debug_enabled = logger.isEnabledFor(logging.DEBUG)
+        indices = []
+        temperatures = []
+        for weather_data in batch:
+            city = weather_data.city
+
+            # Cập nhật dữ liệu mới nhất
+            latest_weather[city] = {
+                'city': city,
+                'temperature': weather_data.temperature,
+                'humidity': weather_data.humidity,
+                'wind_speed': weather_data.wind_speed,
+                'timestamp': weather_data.timestamp,
+            }
+            indices.append(CITY_INDEX[city])
+            temperatures.append(weather_data.temperature)
+
+            # Ghi log dữ liệu nhận được (chỉ khi bật mức DEBUG)
+            if debug_enabled:
+                logger.debug(
+                    RECEIVED_FMT,
+                    city,
+                    weather_data.temperature,
+                    weather_data.humidity,
+                    weather_data.wind_speed,
+                    weather_data.timestamp,
+                )
+
+        # Cộng dồn cả lô vào các mảng, sau đó ghi mỗi thành phố một lần
+        batch_sums = np.zeros(len(CITIES), dtype=np.float64)
+        batch_counts = np.zeros(len(CITIES), dtype=np.int64)
+        aggregate_temperatures(
+            batch_sums,
+            batch_counts,
+            np.array(indices, dtype=np.int64),
+            np.array(temperatures, dtype=np.float64),
+        )
+        for i in np.flatnonzero(batch_counts).tolist():
+            city = CITIES[i]
+            total, count = temperature_state[city] or (0.0, 0)
+            temperature_state[city] = (
+                total + float(batch_sums[i]), count + int(batch_counts[i]))
 
-        # Tính nhiệt độ trung bình chính xác
-        average_temperatures[city] = temperature_sums[city] / temperature_counts[city]
+def json_response(web, payload):
+    # Mã hóa JSON bằng orjson và trả về trực tiếp dạng bytes
+    return web.bytes(orjson.dumps(payload), content_type='application/json')
 
-        # In thông tin dữ liệu nhận được
-        print(f"Received data - City: {city}, "
-              f"Temperature: {weather_data.temperature:.2f}°C, "
-              f"Humidity: {weather_data.humidity:.2f}%, "
-              f"Wind Speed: {weather_data.wind_speed:.2f} m/s, "
-              f"Timestamp: {weather_data.timestamp}")
+# Bộ nhớ đệm ngắn hạn cho kết quả nhiệt độ trung bình
+AVERAGE_CACHE_TTL = 1.0
+_average_cache = {'ts': 0.0, 'body': b''}
 
 # API hiển thị nhiệt độ trung bình của từng thành phố
 @app.page('/average_temperatures/')
 async def get_avg_temperatures(web, request):
-    return web.json({city: temp for city, temp in average_temperatures.items()})
+    now = time.monotonic()
+    if not _average_cache['body'] or (
+            now - _average_cache['ts'] > AVERAGE_CACHE_TTL):
+        # Tính trung bình khi được yêu cầu thay vì lưu thêm một bảng dẫn xuất
+        _average_cache['body'] = orjson.dumps({
+            city: total / count
+            for city, (total, count) in temperature_state.items()
+            if count
+        })
+        _average_cache['ts'] = now
+    return web.bytes(_average_cache['body'], content_type='application/json')
 
 # API hiển thị dữ liệu thời tiết mới nhất
 @app.page('/latest_weather/')
 async def get_latest_weather(web, request):
-    return web.json({
-        city: latest_weather[city] if latest_weather[city] else None
-        for city in latest_weather.keys()
+    return json_response(web, {
+        city: weather or None for city, weather in latest_weather.items()
     })
 
+async def send_weather_batch(records):
+    # Topic.send chỉ chờ bản ghi được đưa vào producer (không chờ broker)
+    # và trả về future của bản ghi đó: đưa lần lượt vào producer để giữ
+    # nguyên thứ tự theo key, rồi chờ broker xác nhận cả lô một lần
+    futures = [
+        await weather_topic.send(key=wd.city, value=wd) for wd in records
+    ]
+    return await asyncio.gather(*futures)
+
 # Sử dụng timer để gửi dữ liệu thời tiết ngẫu nhiên mỗi 5 giây
 @app.timer(5)
 async def produce():
-    cities = ['Hanoi', 'HoChiMinhCity', 'Danang']
-    for city in cities:
-        temperature = random.uniform(20, 40)
-        humidity = random.uniform(50, 100)
-        wind_speed = random.uniform(0, 15)
-        timestamp = str(datetime.datetime.now())
-
+    # Dùng chung một mốc thời gian cho tất cả thành phố trong một lần chạy
+    timestamp = _time_ns()
+    # Sinh toàn bộ giá trị cho mọi thành phố trong một lần gọi
+    values = _rng.uniform(_low, _high, size=(len(CITIES), 3)).tolist()
+    batch = []
+    for city, (temperature, humidity, wind_speed) in zip(CITIES, values):
         weather_data = WeatherData(
             city=city,
             temperature=temperature,
@@ -78,8 +242,10 @@ async def produce():
             wind_speed=wind_speed,
             timestamp=timestamp
         )
+        batch.append(weather_data)
 
-        await weather_topic.send(value=weather_data)
+    # Dùng tên thành phố làm key để mỗi thành phố luôn vào cùng một partition
+    await send_weather_batch(batch)
 
 # Chạy ứng dụng Faust
 if __name__ == '__main__':
@@ -0,0 +1,62 @@
+# cython: language_level=3
+from random import choice
+
+cimport cython
+from libc.stdint cimport uint32_t
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cpdef uint32_t murmur2(const unsigned char[:] data):
+    """Murmur2 hash of data, same as :func:`aiokafka.partitioner.murmur2`."""
+    cdef Py_ssize_t length = data.shape[0]
+    cdef Py_ssize_t tail = length & ~3
+    cdef Py_ssize_t extra = length & 3
+    cdef Py_ssize_t i
+    cdef uint32_t m = 0x5BD1E995
+    cdef uint32_t h = <uint32_t>0x9747B28C ^ <uint32_t>length
+    cdef uint32_t k
+
+    for i in range(0, tail, 4):
+        k = (
+            <uint32_t>data[i]
+            | (<uint32_t>data[i + 1] << 8)
+            | (<uint32_t>data[i + 2] << 16)
+            | (<uint32_t>data[i + 3] << 24)
+        )
+        k *= m
+        k ^= k >> 24
+        k *= m
+        h *= m
+        h ^= k
+
+    if extra >= 3:
+        h ^= <uint32_t>data[tail + 2] << 16
+    if extra >= 2:
+        h ^= <uint32_t>data[tail + 1] << 8
+    if extra >= 1:
+        h ^= <uint32_t>data[tail]
+        h *= m
+
+    h ^= h >> 13
+    h *= m
+    h ^= h >> 15
+    return h
+
+
+cdef class DefaultPartitioner:
+    """Default partitioner, same as :class:`aiokafka.partitioner.DefaultPartitioner`.
+
+    Hashes key to partition using murmur2 hashing (from java client)
+    If key is None, selects partition randomly from available,
+    or from all partitions if none are currently available
+    """
+
+    def __call__(self, object key, object all_partitions, object available):
+        cdef uint32_t idx
+        if key is None:
+            if available:
+                return choice(available)
+            return choice(all_partitions)
+        idx = murmur2(key) & 0x7FFFFFFF
+        return all_partitions[idx % len(all_partitions)]
@@ -50,11 +50,13 @@ import gc
 import typing
 from asyncio import Event
 from collections import defaultdict
+from functools import partial
 from time import monotonic
 from typing import (
     Any,
     AsyncIterator,
     Awaitable,
+    Callable,
     ClassVar,
     Dict,
     Iterable,
@@ -418,6 +420,7 @@ class Consumer(Service, ConsumerT):
     #: Other thread starting to commit while a commit is already active,
     #: will wait for the original request to finish, and do nothing.
     _commit_fut: Optional[asyncio.Future] = None
+    _refreshing_commits: bool = False
 
     #: Set of unacked messages: that is messages that we started processing
     #: and that we MUST attempt to complete processing of, before
@@ -433,6 +436,10 @@ class Consumer(Service, ConsumerT):
     _commit_every: Optional[int]
     _n_acked: int = 0
 
+    #: Number of partitions verify_all_partitions_active checks
+    #: before yielding to the event loop.
+    verify_partitions_per_yield: int = 100
+
     _active_partitions: Set[TP]
     _paused_partitions: Set[TP]
     _buffered_partitions: Set[TP]
@@ -549,6 +556,11 @@ class Consumer(Service, ConsumerT):
     async def _commit(self, offsets: Mapping[TP, int]) -> bool:  # pragma: no cover
         ...
 
+    async def _refresh_commit(self, offsets: Mapping[TP, int]) -> bool:
+        # Commit offsets that were already committed.  Drivers override
+        # this to not count it as progress for livelock detection.
+        return await self._commit(offsets)
+
     async def perform_seek(self) -> None:
         """Seek all partitions to their current committed position."""
         read_offset = self._read_offset
@@ -728,9 +740,12 @@ class Consumer(Service, ConsumerT):
         if records is None or self.should_stop:
             return
 
-        records_it = self.scheduler.iterate(records)
-        to_message = self._to_message  # localize
         if self.flow_active:
+            records_it = self.scheduler.iterate(records)
+            # records are only converted once we know they are yielded,
+            # using a converter created once per partition.
+            message_converter = self._message_converter  # localize
+            converters: Dict[TP, Callable[[Any], ConsumerMessage]] = {}
             for tp, record in records_it:
                 if not self.flow_active:
                     break
@@ -749,8 +764,11 @@ class Consumer(Service, ConsumerT):
                 ):
                     highwater_mark = self.highwater(tp)
                     self.app.monitor.track_tp_end_offset(tp, highwater_mark)
-                    # convert timestamp to seconds from int milliseconds.
-                    yield tp, to_message(tp, record)
+                    try:
+                        to_message = converters[tp]
+                    except KeyError:
+                        to_message = converters[tp] = message_converter(tp)
+                    yield tp, to_message(record)
         else:
             self.log.dev(
                 "getmany called while flow not active. Seek back to committed offsets."
@@ -797,6 +815,11 @@ class Consumer(Service, ConsumerT):
     @abc.abstractmethod
     def _to_message(self, tp: TP, record: Any) -> ConsumerMessage: ...
 
+    def _message_converter(self, tp: TP) -> Callable[[Any], ConsumerMessage]:
+        # Return function converting records from ``tp`` to messages,
+        # drivers can bind what is constant for the partition up front.
+        return partial(self._to_message, tp)
+
     def track_message(self, message: Message) -> None:
         """Track message and mark it as pending ack."""
         # add to set of pending messages that must be acked for graceful
@@ -898,12 +921,56 @@ class Consumer(Service, ConsumerT):
             if not self.app.rebalancing:
                 await self.verify_all_partitions_active()
 
+    @Service.task
+    async def _commit_refresher(self) -> None:
+        interval = self.app.conf.broker_commit_refresh_interval
+        if not interval:
+            return
+        await self.sleep(interval)
+        async for sleep_time in self.itertimer(interval, name="commit_refresh"):
+            if not self.app.rebalancing:
+                await self.refresh_committed_offsets()
+
+    async def refresh_committed_offsets(self) -> bool:
+        """Commit the last committed offsets again.
+
+        Keeps offsets for idle partitions from expiring on the broker,
+        see :setting:`broker_commit_refresh_interval`.
+        """
+        if self.app.client_only or self.in_transaction:
+            # transactions commit offsets through the producer.
+            return False
+        if self._commit_fut is not None or self._refreshing_commits:
+            # a regular commit is in progress, which refreshes the offsets
+            # as well, and we must not commit older offsets after it.
+            return False
+        # Not taking the _commit_fut slot: a regular commit starting
+        # while we refresh must still commit its new offsets, and is
+        # queued to the driver after the refresh so it's the one that sticks.
+        self._refreshing_commits = True
+        try:
+            assignment = self.assignment()
+            offsets = {
+                tp: offset
+                for tp, offset in self._committed_offset.items()
+                if offset is not None and tp in assignment
+            }
+            if not offsets:
+                return False
+            return await self._refresh_commit(offsets)
+        finally:
+            self._refreshing_commits = False
+
     async def verify_all_partitions_active(self) -> None:
         now = monotonic()
-        for tp in self.assignment():
-            await self.sleep(0)
-            if not self.should_stop:
-                self.verify_event_path(now, tp)
+        verify_event_path = self.verify_event_path
+        per_yield = self.verify_partitions_per_yield
+        for i, tp in enumerate(self.assignment()):
+            if not i % per_yield:
+                await self.sleep(0)
+            if self.should_stop:
+                break
+            verify_event_path(now, tp)
 
     def verify_event_path(self, now: float, tp: TP) -> None: ...
 
@@ -1261,6 +1328,14 @@ class ConsumerThread(QueueServiceThread):
         """Commit offsets in topic partitions."""
         ...
 
+    async def refresh_commit(self, tps: Mapping[TP, int]) -> bool:
+        """Commit already committed offsets again.
+
+        Unlike :meth:`commit` this is not recorded as a new commit,
+        so it doesn't hide partitions that stopped making progress.
+        """
+        return await self.commit(tps)
+
     @abc.abstractmethod
     async def position(self, tp: TP) -> Optional[int]:
         """Return the current offset for partition."""
@@ -1451,6 +1526,9 @@ class ThreadDelegateConsumer(Consumer):
     async def _commit(self, offsets: Mapping[TP, int]) -> bool:
         return await self._thread.commit(offsets)
 
+    async def _refresh_commit(self, offsets: Mapping[TP, int]) -> bool:
+        return await self._thread.refresh_commit(offsets)
+
     def close(self) -> None:
         """Close consumer for graceful shutdown."""
         self._thread.close()
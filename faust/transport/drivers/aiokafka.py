@@ -1,16 +1,19 @@
 """Message transport using :pypi:`aiokafka`."""
 
 import asyncio
+import os
 import typing
 from asyncio import Lock, QueueEmpty
 from collections import deque
-from functools import partial
+from functools import lru_cache, partial
+from operator import attrgetter
 from time import monotonic
 from typing import (
     Any,
     Awaitable,
     Callable,
     ClassVar,
+    Collection,
     Deque,
     Iterable,
     List,
@@ -27,9 +30,12 @@ from typing import (
 import aiokafka
 import aiokafka.abc
 import opentracing
-from aiokafka import TopicPartition
+from aiokafka.cluster import ClusterMetadata
 from aiokafka.consumer.group_coordinator import OffsetCommitRequest
 from aiokafka.coordinator.assignors.roundrobin import RoundRobinPartitionAssignor
+from aiokafka.coordinator.assignors.sticky.sticky_assignor import (
+    StickyPartitionAssignor,
+)
 from aiokafka.errors import (
     CommitFailedError,
     ConsumerStoppedError,
@@ -40,7 +46,10 @@ from aiokafka.errors import (
     TopicAlreadyExistsError as TopicExistsError,
     for_code,
 )
-from aiokafka.partitioner import DefaultPartitioner, murmur2
+from aiokafka.partitioner import (
+    DefaultPartitioner as _PyDefaultPartitioner,
+    murmur2 as _py_murmur2,
+)
 from aiokafka.protocol.admin import CreateTopicsRequest
 from aiokafka.protocol.metadata import MetadataRequest_v1
 from aiokafka.structs import OffsetAndMetadata, TopicPartition as _TopicPartition
@@ -75,6 +84,7 @@ from faust.transport.consumer import (
 )
 from faust.types import (
     TP,
+    AppT,
     ConsumerMessage,
     FutureMessage,
     HeadersArg,
@@ -87,6 +97,25 @@ from faust.utils.tracing import noop_span, set_current_span, traced_from_parent_
 
 __all__ = ["Consumer", "Producer", "Transport"]
 
+NO_CYTHON = bool(os.environ.get("NO_CYTHON", False))
+
+if typing.TYPE_CHECKING:
+    DefaultPartitioner = _PyDefaultPartitioner
+    murmur2 = _py_murmur2
+else:
+    if not NO_CYTHON:  # pragma: no cover
+        try:
+            from faust.transport._cython.partitioner import (
+                DefaultPartitioner,
+                murmur2,
+            )
+        except ImportError:
+            DefaultPartitioner = _PyDefaultPartitioner
+            murmur2 = _py_murmur2
+    else:  # pragma: no cover
+        DefaultPartitioner = _PyDefaultPartitioner
+        murmur2 = _py_murmur2
+
 # if not hasattr(aiokafka, '__robinhood__'):  # pragma: no cover
 #     raise RuntimeError(
 #         'Please install robinhood-aiokafka, not aiokafka')
@@ -97,6 +126,10 @@ DEFAULT_GENERATION_ID = OffsetCommitRequest.DEFAULT_GENERATION_ID
 
 TOPIC_LENGTH_MAX = 249
 
+#: Metadata request used to find the controller node.
+#: It has no per-call state, so it is only created once.
+_METADATA_REQUEST_NO_TOPICS = MetadataRequest_v1([])
+
 SLOW_PROCESSING_CAUSE_AGENT = """
 The agent processing the stream is hanging (waiting for network, I/O or \
 infinite loop).
@@ -111,6 +144,12 @@ SLOW_PROCESSING_CAUSE_COMMIT = """
 The commit handler background thread has stopped working (report as bug).
 """.strip()
 
+SLOW_PROCESSING_CAUSE_COMMIT_SLOW = """
+The broker is slow to acknowledge offset commits, and commits requested \
+while one is in flight are skipped.  Consider enabling the \
+broker_commit_async setting so commits don't wait for the broker.
+""".strip()
+
 
 SLOW_PROCESSING_EXPLAINED = """
 
@@ -162,16 +201,52 @@ SLOW_PROCESSING_NO_RECENT_COMMIT = """
 Has not committed %r (last commit %s).
 """.strip()
 
+#: Message timestamp for records without one (typed as float for mypy,
+#: so the per-record conversion doesn't have to call cast()).
+_NO_TIMESTAMP: float = cast(float, None)
+
+
+def _record_to_message(tp: TP, generation_id: int, record: Any) -> ConsumerMessage:
+    timestamp: Optional[int] = record.timestamp
+    return ConsumerMessage(
+        record.topic,
+        record.partition,
+        record.offset,
+        # convert timestamp to seconds from int milliseconds.
+        timestamp / 1000.0 if timestamp is not None else _NO_TIMESTAMP,
+        record.timestamp_type,
+        record.headers,
+        record.key,
+        record.value,
+        record.checksum,
+        record.serialized_key_size,
+        record.serialized_value_size,
+        tp,
+        generation_id=generation_id,
+    )
+
+
+@lru_cache(maxsize=32)
+def _slow_processing_error(
+    msg: str, causes: Tuple[str, ...], setting: str, current_value: float
+) -> str:
+    # There's only a handful of distinct messages, and the same one
+    # is logged again on every livelock check while the problem persists.
+    return " ".join(
+        [
+            msg,
+            SLOW_PROCESSING_EXPLAINED
+            % {"setting": setting, "current_value": current_value},
+            text.enumeration(causes, start=2, sep="\n\n"),
+        ]
+    )
+
 
 def __canon_host(host, default):
     """Ensure host is correctly formatted for aiokafka. That means IPv6
     addresses must enclosed in squared brackets.
     """
-    if not host:
-        return default
-    if ":" in host:
-        return f"[{host}]"
-    return host
+    return (f"[{host}]" if ":" in host else host) if host else default
 
 
 def server_list(urls: List[URL], default_port: int) -> List[str]:
@@ -186,6 +261,8 @@ def server_list(urls: List[URL], default_port: int) -> List[str]:
 class ConsumerRebalanceListener(aiokafka.abc.ConsumerRebalanceListener):  # type: ignore
     # kafka's ridiculous class based callback interface makes this hacky.
 
+    __slots__ = ("_thread",)
+
     def __init__(self, thread: ConsumerThread) -> None:
         self._thread: ConsumerThread = thread
 
@@ -203,10 +280,11 @@ class ConsumerRebalanceListener(aiokafka.abc.ConsumerRebalanceListener):  # type
 
     async def on_partitions_assigned(self, assigned: Iterable[_TopicPartition]) -> None:
         """Call when partitions are being assigned."""
-        generation = self._thread._ensure_consumer()._coordinator.generation
+        thread = self._thread
+        generation = thread._ensure_consumer()._coordinator.generation
         # set the generation on the app
-        self._thread.app.consumer_generation_id = generation
-        await self._thread.on_partitions_assigned(ensure_TPset(assigned), generation)
+        thread.app.consumer_generation_id = generation
+        await thread.on_partitions_assigned(ensure_TPset(assigned), generation)
 
 
 class Consumer(ThreadDelegateConsumer):
@@ -257,25 +335,11 @@ class Consumer(ThreadDelegateConsumer):
         return cast(TP, _TopicPartition(topic, partition))
 
     def _to_message(self, tp: TP, record: Any) -> ConsumerMessage:
-        timestamp: Optional[int] = record.timestamp
-        timestamp_s: float = cast(float, None)
-        if timestamp is not None:
-            timestamp_s = timestamp / 1000.0
-        return ConsumerMessage(
-            record.topic,
-            record.partition,
-            record.offset,
-            timestamp_s,
-            record.timestamp_type,
-            record.headers,
-            record.key,
-            record.value,
-            record.checksum,
-            record.serialized_key_size,
-            record.serialized_value_size,
-            tp,
-            generation_id=self.app.consumer_generation_id,
-        )
+        return _record_to_message(tp, self.app.consumer_generation_id, record)
+
+    def _message_converter(self, tp: TP) -> Callable[[Any], ConsumerMessage]:
+        # getmany stops when the generation changes, so it can be bound.
+        return partial(_record_to_message, tp, self.app.consumer_generation_id)
 
     async def on_stop(self) -> None:
         """Call when consumer is stopping."""
@@ -287,12 +351,36 @@ class Consumer(ThreadDelegateConsumer):
         return self._thread.verify_event_path(now, tp)
 
 
+#: Put on :attr:`ThreadedProducer.event_queue` to stop ``push_events``.
+_STOP = object()
+
+
+def _producer_lingerer(producer: Optional[aiokafka.AIOKafkaProducer]) -> Any:
+    # Private aiokafka attributes, supported versions are pinned in the
+    # tests: aiokafka >= 0.14 applies linger in the message accumulator,
+    # earlier versions keep it on the sender.
+    for attr in ("_message_accumulator", "_sender"):
+        lingerer = getattr(producer, attr, None)
+        if lingerer is not None and hasattr(lingerer, "_linger_time"):
+            return lingerer
+    return None
+
+
 class ThreadedProducer(ServiceThread):
     _producer: Optional[aiokafka.AIOKafkaProducer] = None
     event_queue: Optional[asyncio.Queue] = None
     _default_producer: Optional[aiokafka.AIOKafkaProducer] = None
     _push_events_task: Optional[asyncio.Task] = None
-    app: None
+    _autotune_task: Optional[asyncio.Task] = None
+    app: AppT
+
+    #: How often (in seconds) :setting:`producer_linger_autotune`
+    #: adjusts the linger time.
+    autotune_interval: float = 1.0
+
+    #: Number of buffered messages at which the autotuner
+    #: has brought the linger time all the way down to zero.
+    autotune_queue_high: int = 1000
     stopped: bool
     _shutdown_initiated: bool = False
 
@@ -323,16 +411,26 @@ class ThreadedProducer(ServiceThread):
 
     async def flush(self) -> None:
         """Wait for producer to finish transmitting all buffered messages."""
-        while True:
-            try:
-                msg = self.event_queue.get_nowait()
-            except QueueEmpty:
-                break
+        for msg in self._drain_events():
+            if msg is _STOP:
+                # push_events has not seen it yet, so keep it queued.
+                self.event_queue.put_nowait(msg)
             else:
                 await self.publish_message(msg)
         if self._producer is not None:
             await self._producer.flush()
 
+    def _drain_events(self) -> List[FutureMessage]:
+        # Take everything currently buffered in one go, so callers
+        # don't go back to the queue (and wait_for) for every message.
+        events: List[FutureMessage] = []
+        get_nowait = self.event_queue.get_nowait
+        while True:
+            try:
+                events.append(get_nowait())
+            except QueueEmpty:
+                return events
+
     def _new_producer(
         self, transactional_id: Optional[str] = None
     ) -> aiokafka.AIOKafkaProducer:
@@ -352,6 +450,8 @@ class ThreadedProducer(ServiceThread):
         await producer.start()
         self.stopped = False
         self._push_events_task = self.thread_loop.create_task(self.push_events())
+        if self.app.conf.producer_linger_autotune:
+            self._autotune_task = self.thread_loop.create_task(self._autotune_linger())
 
     async def on_thread_stop(self) -> None:
         """Call when producer thread is stopping."""
@@ -359,25 +459,73 @@ class ThreadedProducer(ServiceThread):
         logger.info("Stopping producer thread")
         await super().on_thread_stop()
         self.stopped = True
-        # when method queue is stopped, we can stop the consumer
-        if self._producer is not None:
-            await self.flush()
-            await self._producer.stop()
-        if self._push_events_task is not None:
-            while not self._push_events_task.done():
-                await asyncio.sleep(0.1)
+        if self._autotune_task is not None:
+            self.thread_loop.call_soon_threadsafe(self._autotune_task.cancel)
+        push_events_task = self._push_events_task
+        try:
+            if push_events_task is not None:
+                # wake up push_events so it can publish what's left and exit.
+                self.thread_loop.call_soon_threadsafe(
+                    self.event_queue.put_nowait, _STOP
+                )
+                # cancels push_events if it doesn't finish in time.
+                waiter = asyncio.wait_for(push_events_task, self.shutdown_timeout)
+                if asyncio.get_running_loop() is self.thread_loop:
+                    await waiter
+                else:  # the task belongs to the thread loop, wait there.
+                    await asyncio.wrap_future(
+                        asyncio.run_coroutine_threadsafe(waiter, self.thread_loop)
+                    )
+        except asyncio.TimeoutError:
+            logger.warning(
+                "Producer thread push_events did not stop in %rs",
+                self.shutdown_timeout,
+            )
+        except Exception as exc:
+            # push_events died publishing a message, but the
+            # producer must still be stopped to close its connections.
+            logger.exception("Producer thread push_events raised: %r", exc)
+        finally:
+            # when method queue is stopped, we can stop the consumer
+            if self._producer is not None:
+                await self.flush()
+                await self._producer.stop()
 
     async def push_events(self):
-        while not self.stopped:
-            try:
-                event = await asyncio.wait_for(self.event_queue.get(), timeout=0.1)
-            except asyncio.TimeoutError:
-                continue
-
+        queue = self.event_queue
+        assert queue is not None  # created in on_start
+        get = queue.get
+        stopping = False
+        while not stopping:
+            event = await get()
             self.app.sensors.on_threaded_producer_buffer_processed(
-                app=self.app, size=self.event_queue.qsize()
+                app=self.app, size=queue.qsize()
             )
-            await self.publish_message(event)
+            # Messages are published in order: aiokafka only suspends
+            # here when its batch accumulator is full.
+            for pending in (event, *self._drain_events()):
+                if pending is _STOP:
+                    stopping = True
+                else:
+                    await self.publish_message(pending)
+
+    async def _autotune_linger(self) -> None:
+        # aiokafka has no public API to change linger after the producer
+        # is created, so we adjust whichever object aiokafka reads it from.
+        lingerer = _producer_lingerer(self._producer)
+        if lingerer is None:
+            logger.warning("producer_linger_autotune not supported by aiokafka")
+            return
+        queue = self.event_queue
+        assert queue is not None  # created in on_start
+        base_linger = lingerer._linger_time
+        while not self.stopped:
+            await asyncio.sleep(self.autotune_interval)
+            # Send sooner the more messages we have waiting
+            # to be published, and go back to the configured linger
+            # once the buffer is drained.
+            fullness = min(queue.qsize() / self.autotune_queue_high, 1.0)
+            lingerer._linger_time = base_linger * (1.0 - fullness)
 
     async def publish_message(
         self, fut_other: FutureMessage, wait: bool = False
@@ -407,8 +555,16 @@ class ThreadedProducer(ServiceThread):
             keysize=len(key) if key else 0,
             valsize=len(value) if value else 0,
         )
-        timestamp_ms = int(timestamp * 1000.0) if timestamp else timestamp
-        if headers is not None:
+        if not timestamp:
+            timestamp_ms = timestamp
+        elif type(timestamp) is int:
+            # whole seconds: stay in integer arithmetic
+            timestamp_ms = timestamp * 1000
+        else:
+            timestamp_ms = int(timestamp * 1000.0)
+        # headers are usually already a list (or None), so avoid the
+        # comparatively slow isinstance check against the Mapping ABC.
+        if headers is not None and type(headers) is not list:
             if isinstance(headers, Mapping):
                 headers = list(headers.items())
         if wait:
@@ -450,6 +606,29 @@ class ThreadedProducer(ServiceThread):
 class AIOKafkaConsumerThread(ConsumerThread):
     _consumer: Optional[aiokafka.AIOKafkaConsumer] = None
     _pending_rebalancing_spans: Deque[opentracing.Span]
+    _commit_tasks: Set[asyncio.Future]
+    _pending_commit_offsets: MutableMapping[_TopicPartition, OffsetAndMetadata]
+    _commit_flush_handle: Optional[asyncio.TimerHandle] = None
+    _rebalance_trace_ids: MutableMapping[int, int]
+    _aiokafka_tps: MutableMapping[TP, _TopicPartition]
+    _partitions_cache: MutableMapping[str, Tuple[List[int], List[int]]]
+
+    #: Number of generations to cache rebalancing span trace ids for.
+    max_rebalance_trace_ids: ClassVar[int] = 8
+
+    #: Lower bound for max records per poll when it is adjusted
+    #: by :setting:`broker_max_poll_records_target_latency`.
+    min_adaptive_max_records: ClassVar[int] = 10
+
+    #: Weight of the latest batch in the moving average
+    #: of the time taken to handle each record.
+    record_latency_decay: ClassVar[float] = 0.2
+
+    max_records_target_latency: float
+    _adaptive_max_records: Optional[int] = None
+    _record_latency: Optional[float] = None
+    _last_batch_size: int = 0
+    _last_batch_returned_at: Optional[float] = None
 
     tp_last_committed_at: MutableMapping[TP, float]
     time_started: float
@@ -466,6 +645,11 @@ class AIOKafkaConsumerThread(ConsumerThread):
         )
         self._rebalance_listener = consumer.RebalanceListener(self)
         self._pending_rebalancing_spans = deque()
+        self._rebalance_trace_ids = {}
+        self._aiokafka_tps = {}
+        self._partitions_cache = {}
+        self._commit_tasks = set()
+        self._pending_commit_offsets = {}
         self.tp_last_committed_at = {}
 
         app = self.consumer.app
@@ -478,20 +662,51 @@ class AIOKafkaConsumerThread(ConsumerThread):
         commit_livelock_timeout = app.conf.broker_commit_livelock_soft_timeout
         self.tp_commit_timeout_secs = commit_livelock_timeout
 
+        target_latency = app.conf.broker_max_poll_records_target_latency
+        self.max_records_target_latency = target_latency
+
     async def on_start(self) -> None:
         """Call when consumer starts."""
         self._consumer = self._create_consumer(loop=self.thread_loop)
+        self._consumer._client.cluster.add_listener(self._on_metadata_change)
         self.time_started = monotonic()
         await self._consumer.start()
 
+    def _on_metadata_change(self, cluster: ClusterMetadata) -> None:
+        # Replaced rather than cleared so that a key_partition() call
+        # racing with the update cannot store partitions read from
+        # the old metadata into the new cache.
+        self._partitions_cache = {}
+
     async def on_thread_stop(self) -> None:
         """Call when consumer thread is stopping."""
         # super stops thread method queue (QueueServiceThread.method_queue)
         await super().on_thread_stop()
         # when method queue is stopped, we can stop the consumer
         if self._consumer is not None:
+            await self._wait_for_commits()
             await self._consumer.stop()
 
+    async def _wait_for_commits(self) -> None:
+        if self._commit_flush_handle is not None:
+            # send lingering commits now rather than dropping them.
+            self._commit_flush_handle.cancel()
+            self._flush_commits()
+        # let in-flight async commits finish first.
+        if self._commit_tasks:
+            await asyncio.gather(*self._commit_tasks, return_exceptions=True)
+
+    async def on_partitions_revoked(self, revoked: Set[TP]) -> None:
+        """Call on rebalance when partitions are being revoked."""
+        aiokafka_tps = self._aiokafka_tps
+        for tp in revoked:
+            aiokafka_tps.pop(tp, None)
+        await super().on_partitions_revoked(revoked)
+        # Offsets committed while revoking must reach the broker before
+        # we rejoin the group, or the commit fails as "already rebalanced"
+        # and the new owner of the partitions processes them again.
+        await self._wait_for_commits()
+
     def _create_consumer(
         self, loop: asyncio.AbstractEventLoop
     ) -> aiokafka.AIOKafkaConsumer:
@@ -505,57 +720,24 @@ class AIOKafkaConsumerThread(ConsumerThread):
         self, transport: "Transport"
     ) -> aiokafka.AIOKafkaConsumer:
         isolation_level: str = "read_uncommitted"
-        conf = self.app.conf
         if self.consumer.in_transaction:
             isolation_level = "read_committed"
-        self._assignor = (
-            self.app.assignor
-            if self.app.conf.table_standby_replicas > 0
-            else RoundRobinPartitionAssignor
-        )
-        auth_settings = credentials_to_aiokafka_auth(
-            conf.broker_credentials, conf.ssl_context
-        )
-        max_poll_interval = conf.broker_max_poll_interval or 0
-
-        request_timeout = conf.broker_request_timeout
-        session_timeout = conf.broker_session_timeout
-        rebalance_timeout = conf.broker_rebalance_timeout
-
-        if session_timeout > request_timeout:
-            raise ImproperlyConfigured(
-                f"Setting broker_session_timeout={session_timeout} "
-                f"cannot be greater than "
-                f"broker_request_timeout={request_timeout}"
-            )
-
+        conf = self.app.conf
+        if conf.table_standby_replicas > 0:
+            self._assignor = self.app.assignor
+        elif conf.broker_use_sticky_assignor:
+            self._assignor = StickyPartitionAssignor
+        else:
+            self._assignor = RoundRobinPartitionAssignor
         return aiokafka.AIOKafkaConsumer(
-            api_version=conf.consumer_api_version,
-            client_id=conf.broker_client_id,
-            group_id=conf.id,
-            group_instance_id=conf.consumer_group_instance_id,
-            bootstrap_servers=server_list(transport.url, transport.default_port),
             partition_assignment_strategy=[self._assignor],
-            enable_auto_commit=False,
-            auto_offset_reset=conf.consumer_auto_offset_reset,
-            max_poll_records=conf.broker_max_poll_records,
-            max_poll_interval_ms=int(max_poll_interval * 1000.0),
-            max_partition_fetch_bytes=conf.consumer_max_fetch_size,
-            fetch_max_wait_ms=1500,
-            request_timeout_ms=int(request_timeout * 1000.0),
-            check_crcs=conf.broker_check_crcs,
-            session_timeout_ms=int(session_timeout * 1000.0),
-            rebalance_timeout_ms=int(rebalance_timeout * 1000.0),
-            heartbeat_interval_ms=int(conf.broker_heartbeat_interval * 1000.0),
             isolation_level=isolation_level,
-            metadata_max_age_ms=conf.consumer_metadata_max_age_ms,
-            connections_max_idle_ms=conf.consumer_connections_max_idle_ms,
             # traced_from_parent_span=self.traced_from_parent_span,
             # start_rebalancing_span=self.start_rebalancing_span,
             # start_coordinator_span=self.start_coordinator_span,
             # on_generation_id_known=self.on_generation_id_known,
             # flush_spans=self.flush_spans,
-            **auth_settings,
+            **transport.worker_consumer_settings,
         )
 
     def _create_client_consumer(
@@ -568,7 +750,7 @@ class AIOKafkaConsumerThread(ConsumerThread):
         max_poll_interval = conf.broker_max_poll_interval or 0
         return aiokafka.AIOKafkaConsumer(
             client_id=conf.broker_client_id,
-            bootstrap_servers=server_list(transport.url, transport.default_port),
+            bootstrap_servers=transport.bootstrap_servers,
             request_timeout_ms=int(conf.broker_request_timeout * 1000.0),
             enable_auto_commit=True,
             max_poll_records=conf.broker_max_poll_records,
@@ -605,21 +787,8 @@ class AIOKafkaConsumerThread(ConsumerThread):
 
     @no_type_check
     def _transform_span_lazy(self, span: opentracing.Span) -> None:
-        # XXX slow
-        consumer = self
-        if typing.TYPE_CHECKING:
-            # MyPy completely disallows the statements below
-            # claiming it is an illegal dynamic baseclass.
-            # We know mypy, but do it anyway :D
-            pass
-        else:
-            cls = span.__class__
-
-            class LazySpan(cls):
-                def finish(self) -> None:
-                    consumer._span_finish(span)
-
-            span._real_finish, span.finish = span.finish, LazySpan.finish
+        # Patch the instance rather than creating a subclass per span.
+        span._real_finish, span.finish = span.finish, partial(self._span_finish, span)
 
     def _span_finish(self, span: opentracing.Span) -> None:
         assert self._consumer is not None
@@ -645,9 +814,7 @@ class AIOKafkaConsumerThread(ConsumerThread):
             except AttributeError:  # pragma: no cover
                 pass  # not a real span
             else:
-                trace_id_str = f"reb-{app_id}-{generation}"
-                trace_id = murmur2(trace_id_str.encode())
-
+                trace_id = self._rebalance_trace_id(app_id, generation)
                 span.context.trace_id = trace_id
                 if op_name.endswith(".REPLACE_WITH_MEMBER_ID"):
                     span.set_operation_name(f"rebalancing node {member_id}")
@@ -657,6 +824,18 @@ class AIOKafkaConsumerThread(ConsumerThread):
                 self.app._span_add_default_tags(span)
                 span._real_finish()
 
+    def _rebalance_trace_id(self, app_id: str, generation: int) -> int:
+        # Every span finished in a rebalance shares the same trace id,
+        # so only hash it once per generation.
+        trace_ids = self._rebalance_trace_ids
+        trace_id = trace_ids.get(generation)
+        if trace_id is None:
+            trace_id_str = f"reb-{app_id}-{generation}"
+            trace_id = trace_ids[generation] = murmur2(trace_id_str.encode())
+            if len(trace_ids) > self.max_rebalance_trace_ids:
+                del trace_ids[next(iter(trace_ids))]
+        return trace_id
+
     def _on_span_cancelled_early(self, span: opentracing.Span) -> None:
         try:
             op_name = span.operation_name
@@ -676,14 +855,22 @@ class AIOKafkaConsumerThread(ConsumerThread):
         )
 
     def flush_spans(self) -> None:
-        while self._pending_rebalancing_spans:
-            span = self._pending_rebalancing_spans.popleft()
-            self._on_span_cancelled_early(span)
+        pending, self._pending_rebalancing_spans = (
+            self._pending_rebalancing_spans,
+            deque(),
+        )
+        on_span_cancelled_early = self._on_span_cancelled_early
+        for span in pending:
+            on_span_cancelled_early(span)
 
     def on_generation_id_known(self) -> None:
-        while self._pending_rebalancing_spans:
-            span = self._pending_rebalancing_spans.popleft()
-            self._on_span_generation_known(span)
+        pending, self._pending_rebalancing_spans = (
+            self._pending_rebalancing_spans,
+            deque(),
+        )
+        on_span_generation_known = self._on_span_generation_known
+        for span in pending:
+            on_span_generation_known(span)
 
     def close(self) -> None:
         """Close consumer for graceful shutdown."""
@@ -713,19 +900,90 @@ class AIOKafkaConsumerThread(ConsumerThread):
         """Commit topic offsets."""
         return await self.call_thread(self._commit, offsets)
 
+    async def refresh_commit(self, offsets: Mapping[TP, int]) -> bool:
+        """Commit already committed offsets again."""
+        return await self.call_thread(self._refresh_commit, offsets)
+
+    async def _refresh_commit(self, offsets: Mapping[TP, int]) -> bool:
+        # Straight to the broker: no linger, and tp_last_committed_at
+        # is left alone so livelock detection still sees idle partitions.
+        is_assigned = self.assignment().__contains__
+        aiokafka_tp = self._aiokafka_tp
+        aiokafka_offsets = {
+            aiokafka_tp(tp): OffsetAndMetadata(offset, "")
+            for tp, offset in offsets.items()
+            if is_assigned(tp)
+        }
+        if not aiokafka_offsets:
+            return False
+        return await self._commit_offsets(self._ensure_consumer(), aiokafka_offsets)
+
     async def _commit(self, offsets: Mapping[TP, int]) -> bool:
         consumer = self._ensure_consumer()
         now = monotonic()
+        # assignment() converts aiokafka's assignment to a new set
+        # on every call, so only do that once per commit.
+        is_assigned = self.assignment().__contains__
         commitable_offsets = {
-            tp: offset for tp, offset in offsets.items() if tp in self.assignment()
+            tp: offset for tp, offset in offsets.items() if is_assigned(tp)
+        }
+        aiokafka_tp = self._aiokafka_tp
+        aiokafka_offsets = {
+            aiokafka_tp(tp): OffsetAndMetadata(offset, "")
+            for tp, offset in commitable_offsets.items()
         }
+        self.tp_last_committed_at.update(dict.fromkeys(commitable_offsets, now))
+        conf = self.app.conf
+        if conf.broker_commit_async:
+            # Consumer.commit() only has one commit in flight at a time,
+            # so commits can only be merged when callers don't wait.
+            linger = conf.broker_commit_linger
+            if linger:
+                self._add_pending_commit(aiokafka_offsets, linger)
+            else:
+                self._commit_async(consumer, aiokafka_offsets)
+            return True
+        return await self._commit_offsets(consumer, aiokafka_offsets)
+
+    def _add_pending_commit(
+        self, offsets: Mapping[_TopicPartition, OffsetAndMetadata], linger: float
+    ) -> None:
+        # Merge into the offsets waiting for the next flush,
+        # the highest offset for a partition wins.
+        pending = self._pending_commit_offsets
+        for tp, metadata in offsets.items():
+            current = pending.get(tp)
+            if current is None or metadata.offset > current.offset:
+                pending[tp] = metadata
+        if self._commit_flush_handle is None:
+            self._commit_flush_handle = self.thread_loop.call_later(
+                linger, self._flush_commits
+            )
+
+    def _flush_commits(self) -> None:
+        self._commit_flush_handle = None
+        offsets, self._pending_commit_offsets = self._pending_commit_offsets, {}
+        if offsets:
+            self._commit_async(self._ensure_consumer(), offsets)
+
+    def _commit_async(
+        self,
+        consumer: aiokafka.AIOKafkaConsumer,
+        offsets: Mapping[_TopicPartition, OffsetAndMetadata],
+    ) -> None:
+        # Fire-and-forget: errors are handled by _commit_offsets
+        # inside the task, we only keep a reference until it's done.
+        fut = asyncio.ensure_future(self._commit_offsets(consumer, offsets))
+        self._commit_tasks.add(fut)
+        fut.add_done_callback(self._commit_tasks.discard)
+
+    async def _commit_offsets(
+        self,
+        consumer: aiokafka.AIOKafkaConsumer,
+        offsets: Mapping[_TopicPartition, OffsetAndMetadata],
+    ) -> bool:
         try:
-            aiokafka_offsets = {
-                ensure_aiokafka_TP(tp): OffsetAndMetadata(offset, "")
-                for tp, offset in commitable_offsets.items()
-            }
-            self.tp_last_committed_at.update({tp: now for tp in commitable_offsets})
-            await consumer.commit(aiokafka_offsets)
+            await consumer.commit(offsets)
         except CommitFailedError as exc:
             if "already rebalanced" in str(exc):
                 return False
@@ -759,10 +1017,8 @@ class AIOKafkaConsumerThread(ConsumerThread):
         secs_since_started = now - self.time_started
 
         if monitor is not None:  # need for .stream_inbound_time
-            aiotp = TopicPartition(tp.topic, tp.partition)
-            tp_state = self._ensure_consumer()._fetcher._subscriptions.subscription.assignment.state_value(  # noqa: E501
-                aiotp
-            )
+            subscription = self._ensure_consumer()._fetcher._subscriptions.subscription
+            tp_state = subscription.assignment.state_value(self._aiokafka_tp(tp))
             highwater = tp_state.highwater
             committed_offset = tp_state.position
             has_acks = acks_enabled_for(tp.topic)
@@ -829,6 +1085,17 @@ class AIOKafkaConsumerThread(ConsumerThread):
                             )
                             return None
 
+    def _aiokafka_tp(self, tp: TP) -> _TopicPartition:
+        # The event path is verified for every assigned partition
+        # on every tick, and commits convert every committed partition,
+        # so reuse the converted TopicPartition.
+        # Entries are dropped again when the partition is revoked.
+        try:
+            return self._aiokafka_tps[tp]
+        except KeyError:
+            aiotp = self._aiokafka_tps[tp] = _TopicPartition(tp.topic, tp.partition)
+            return aiotp
+
     def verify_recovery_event_path(self, now: float, tp: TP) -> None:
         self._verify_aiokafka_event_path(now, tp)
 
@@ -839,7 +1106,7 @@ class AIOKafkaConsumerThread(ConsumerThread):
         """
         consumer = self._ensure_consumer()
         secs_since_started = now - self.time_started
-        aiotp = TopicPartition(tp.topic, tp.partition)
+        aiotp = self._aiokafka_tp(tp)
         assignment = consumer._fetcher._subscriptions.subscription.assignment
         if not assignment or not assignment.active:
             self.log.error(f"No active partitions for {tp}")
@@ -888,7 +1155,7 @@ class AIOKafkaConsumerThread(ConsumerThread):
         self._log_slow_processing(
             msg,
             *args,
-            causes=[SLOW_PROCESSING_CAUSE_COMMIT],
+            causes=[SLOW_PROCESSING_CAUSE_COMMIT, SLOW_PROCESSING_CAUSE_COMMIT_SLOW],
             setting="broker_commit_livelock_soft_timeout",
             current_value=app.conf.broker_commit_livelock_soft_timeout,
         )
@@ -896,14 +1163,7 @@ class AIOKafkaConsumerThread(ConsumerThread):
     def _make_slow_processing_error(
         self, msg: str, causes: Iterable[str], setting: str, current_value: float
     ) -> str:
-        return " ".join(
-            [
-                msg,
-                SLOW_PROCESSING_EXPLAINED
-                % {"setting": setting, "current_value": current_value},
-                text.enumeration(causes, start=2, sep="\n\n"),
-            ]
-        )
+        return _slow_processing_error(msg, tuple(causes), setting, current_value)
 
     def _log_slow_processing(
         self,
@@ -934,18 +1194,28 @@ class AIOKafkaConsumerThread(ConsumerThread):
     async def _seek_wait(
         self, consumer: Consumer, partitions: Mapping[TP, int]
     ) -> None:
+        read_offset = self.consumer._read_offset
         for tp, offset in partitions.items():
             self.log.dev("SEEK %r -> %r", tp, offset)
             consumer.seek(tp, offset)
             if offset > 0:
-                self.consumer._read_offset[tp] = offset
-            elif tp in self.consumer._read_offset.keys():
-                del self.consumer._read_offset[tp]
+                read_offset[tp] = offset
+            else:
+                read_offset.pop(tp, None)
         await asyncio.wait_for(
-            asyncio.gather(*[consumer.position(tp) for tp in partitions]),
+            self._wait_positions(consumer, partitions),
             timeout=self.app.conf.broker_request_timeout,
         )
 
+    async def _wait_positions(
+        self, consumer: Consumer, partitions: Iterable[TP]
+    ) -> None:
+        # We just seeked, so position() usually returns without suspending:
+        # awaiting them in turn avoids creating a task per partition
+        # like asyncio.gather would, and takes no longer in total.
+        for tp in partitions:
+            await consumer.position(tp)
+
     def seek(self, partition: TP, offset: int) -> None:
         """Seek partition to specific offset."""
         self._ensure_consumer().seek(partition, offset)
@@ -956,10 +1226,11 @@ class AIOKafkaConsumerThread(ConsumerThread):
 
     def highwater(self, tp: TP) -> int:
         """Return the last offset in a specific partition."""
+        consumer = self._ensure_consumer()
         if self.consumer.in_transaction:
-            return self._ensure_consumer().last_stable_offset(tp)
+            return consumer.last_stable_offset(tp)
         else:
-            return self._ensure_consumer().highwater(tp)
+            return consumer.highwater(tp)
 
     def topic_partitions(self, topic: str) -> Optional[int]:
         """Return the number of partitions configured for topic by name."""
@@ -980,14 +1251,37 @@ class AIOKafkaConsumerThread(ConsumerThread):
     async def _highwaters(self, partitions: List[TP]) -> Mapping[TP, int]:
         consumer = self._ensure_consumer()
         if self.consumer.in_transaction:
-            return {tp: consumer.last_stable_offset(tp) for tp in partitions}
+            return self._last_stable_offsets(consumer, partitions)
         else:
             return cast(Mapping[TP, int], await consumer.end_offsets(partitions))
 
+    def _last_stable_offsets(
+        self, consumer: aiokafka.AIOKafkaConsumer, partitions: Iterable[TP]
+    ) -> Mapping[TP, int]:
+        # Resolve the assignment once instead of going through
+        # consumer.last_stable_offset() for every partition; partitions
+        # without state still go through it so unassigned partitions
+        # raise the same error as before.
+        subscription = consumer._fetcher._subscriptions.subscription
+        assignment = subscription.assignment if subscription is not None else None
+        if assignment is None:
+            return {tp: consumer.last_stable_offset(tp) for tp in partitions}
+        state_value = assignment.state_value
+        aiokafka_tp = self._aiokafka_tp
+        offsets: MutableMapping[TP, int] = {}
+        for tp in partitions:
+            state = state_value(aiokafka_tp(tp))
+            if state is None:
+                offsets[tp] = consumer.last_stable_offset(tp)
+            else:
+                offsets[tp] = state.lso
+        return offsets
+
     def _ensure_consumer(self) -> aiokafka.AIOKafkaConsumer:
-        if self._consumer is None:
+        consumer = self._consumer
+        if consumer is None:
             raise ConsumerNotStarted("Consumer thread not yet started")
-        return self._consumer
+        return consumer
 
     async def getmany(
         self, active_partitions: Optional[Set[TP]], timeout: float
@@ -999,13 +1293,52 @@ class AIOKafkaConsumerThread(ConsumerThread):
         # we need to check when dequeued that we are not in a rebalancing
         # state at that point to return early, or we
         # will create a deadlock (fetch request starts after flow stopped)
-        return await self.call_thread(
+        max_records = _consumer._max_poll_records
+        if not max_records or not self.max_records_target_latency:
+            return await self.call_thread(
+                self._fetch_records,
+                _consumer,
+                active_partitions,
+                timeout=timeout,
+                max_records=max_records,
+            )
+        records = await self.call_thread(
             self._fetch_records,
             _consumer,
             active_partitions,
             timeout=timeout,
-            max_records=_consumer._max_poll_records,
+            max_records=self._adapt_max_records(max_records, monotonic()),
         )
+        self._last_batch_size = sum(map(len, records.values()))
+        self._last_batch_returned_at = monotonic()
+        return records
+
+    def _adapt_max_records(self, max_records: int, now: float) -> int:
+        # The time from one getmany returning to the next one being
+        # called is spent handing the records over to streams, which
+        # blocks when the stream buffers are full.  Keep a moving average
+        # of that time per record and ask for as many records as can be
+        # handled within the target latency.
+        returned_at = self._last_batch_returned_at
+        batch_size = self._last_batch_size
+        if returned_at is not None and batch_size:
+            latency = (now - returned_at) / batch_size
+            average = self._record_latency
+            if average is None:
+                average = latency
+            else:
+                average += self.record_latency_decay * (latency - average)
+            self._record_latency = average
+            wanted = (
+                int(self.max_records_target_latency / average)
+                if average > 0.0
+                else max_records
+            )
+            self._adaptive_max_records = min(
+                max_records, max(self.min_adaptive_max_records, wanted)
+            )
+        adaptive = self._adaptive_max_records
+        return max_records if adaptive is None else adaptive
 
     async def _fetch_records(
         self,
@@ -1019,15 +1352,21 @@ class AIOKafkaConsumerThread(ConsumerThread):
         fetcher = consumer._fetcher
         if consumer._closed or fetcher._closed:
             raise ConsumerStoppedError()
-        with fetcher._subscriptions.fetch_context():
-            try:
-                return await fetcher.fetched_records(
-                    active_partitions,
-                    timeout=timeout,
-                    max_records=max_records,
-                )
-            finally:
-                pass
+        # Same bookkeeping as SubscriptionState.fetch_context(), without
+        # the generator based context manager, and the fetch count is
+        # also restored if the fetch is cancelled or raises.
+        subscriptions = fetcher._subscriptions
+        subscriptions._fetch_count += 1
+        try:
+            return await fetcher.fetched_records(
+                active_partitions,
+                timeout=timeout,
+                max_records=max_records,
+            )
+        finally:
+            subscriptions._fetch_count -= 1
+            if not subscriptions._fetch_count:
+                subscriptions._last_fetch_ended = monotonic()
 
     async def create_topic(
         self,
@@ -1074,16 +1413,26 @@ class AIOKafkaConsumerThread(ConsumerThread):
         """Hash key to determine partition destination."""
         consumer = self._ensure_consumer()
         metadata = consumer._client.cluster
-        partitions_for_topic = metadata.partitions_for_topic(topic)
-        if partitions_for_topic is None:
-            return None
         if partition is not None:
+            partitions_for_topic = metadata.partitions_for_topic(topic)
+            if partitions_for_topic is None:
+                return None
             assert partition >= 0
             assert partition in partitions_for_topic, "Unrecognized partition"
             return partition
 
-        all_partitions = list(partitions_for_topic)
-        available = list(metadata.available_partitions_for_topic(topic))
+        # The partition lists only change when metadata is refreshed,
+        # so they are cached per topic until _on_metadata_change.
+        cache = self._partitions_cache
+        try:
+            all_partitions, available = cache[topic]
+        except KeyError:
+            partitions_for_topic = metadata.partitions_for_topic(topic)
+            if partitions_for_topic is None:
+                return None
+            all_partitions = list(partitions_for_topic)
+            available = list(metadata.available_partitions_for_topic(topic))
+            cache[topic] = (all_partitions, available)
         return self._partitioner(key, all_partitions, available)
 
 
@@ -1094,14 +1443,30 @@ class Producer(base.Producer):
 
     allow_headers: bool = True
     _producer: Optional[aiokafka.AIOKafkaProducer] = None
-    _transaction_producers: typing.Dict[str, aiokafka.AIOKafkaProducer] = {}
-    _trn_locks: typing.Dict[str, Lock] = {}
+    _inflight: Optional[asyncio.Semaphore] = None
+    _transaction_producers: typing.Dict[str, aiokafka.AIOKafkaProducer]
+    _trn_locks: typing.Dict[str, Lock]
+    _produce_message_receivers: Optional[Collection]
+    _produce_message_filter_receivers: Optional[Mapping]
 
     def create_threaded_producer(self):
         return ThreadedProducer(default_producer=self, app=self.app)
 
     def __post_init__(self) -> None:
-        self._send_on_produce_message = self.app.on_produce_message.send
+        on_produce_message = self.app.on_produce_message
+        self._send_on_produce_message = on_produce_message.send
+        # These are shared with the signal the handlers connect to,
+        # so send() can see that nobody is listening without having
+        # to dispatch the signal.  mode has no public API for this,
+        # so if the attributes are missing we always dispatch.
+        receivers = getattr(on_produce_message, "_receivers", None)
+        filter_receivers = getattr(on_produce_message, "_filter_receivers", None)
+        if receivers is None or filter_receivers is None:
+            receivers = filter_receivers = None
+        self._produce_message_receivers = receivers
+        self._produce_message_filter_receivers = filter_receivers
+        self._transaction_producers = {}
+        self._trn_locks = {}
         if self.partitioner is None:
             self.partitioner = DefaultPartitioner()
         if self._api_version != "auto":
@@ -1112,7 +1477,7 @@ class Producer(base.Producer):
     def _settings_default(self) -> Mapping[str, Any]:
         transport = cast(Transport, self.transport)
         return {
-            "bootstrap_servers": server_list(transport.url, transport.default_port),
+            "bootstrap_servers": transport.bootstrap_servers,
             "client_id": self.client_id,
             "acks": self.acks,
             "linger_ms": self.linger_ms,
@@ -1217,28 +1582,51 @@ class Producer(base.Producer):
         start_new_transaction: bool = True,
     ) -> None:
         """Commit transactions."""
-        for transactional_id, offsets in tid_to_offset_map.items():
-            # get the producer
-            async with self._trn_locks[transactional_id]:
-                transaction_producer = self._transaction_producers.get(transactional_id)
-                if transaction_producer:
-                    logger.debug(
-                        f"Sending offsets {offsets} to transaction {transactional_id}"
-                    )
-                    await transaction_producer.send_offsets_to_transaction(
-                        offsets, group_id
-                    )
-                    await transaction_producer.commit_transaction()
-                    logger.debug(f"Done committing transaction {transactional_id}")
-                    if start_new_transaction:
-                        logger.debug(f"Starting transaction {transactional_id}")
-                        await transaction_producer.begin_transaction()
-                        logger.debug(f"Started transaction {transactional_id}")
+        # Every transactional id has its own producer and lock,
+        # so the commits are independent and can run concurrently.
+        # All of them are allowed to finish before the first error
+        # (if any) is raised.
+        results = await asyncio.gather(
+            *[
+                self._commit_transaction_offsets(
+                    transactional_id, offsets, group_id, start_new_transaction
+                )
+                for transactional_id, offsets in tid_to_offset_map.items()
+            ],
+            return_exceptions=True,
+        )
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
 
-                else:
-                    logger.warning(
-                        f"Commit invoked for unknown transaction {transactional_id}"
-                    )
+    async def _commit_transaction_offsets(
+        self,
+        transactional_id: str,
+        offsets: Mapping[TP, int],
+        group_id: str,
+        start_new_transaction: bool,
+    ) -> None:
+        # get the producer
+        async with self._trn_locks[transactional_id]:
+            transaction_producer = self._transaction_producers.get(transactional_id)
+            if transaction_producer:
+                logger.debug(
+                    f"Sending offsets {offsets} to transaction {transactional_id}"
+                )
+                await transaction_producer.send_offsets_to_transaction(
+                    offsets, group_id
+                )
+                await transaction_producer.commit_transaction()
+                logger.debug(f"Done committing transaction {transactional_id}")
+                if start_new_transaction:
+                    logger.debug(f"Starting transaction {transactional_id}")
+                    await transaction_producer.begin_transaction()
+                    logger.debug(f"Started transaction {transactional_id}")
+
+            else:
+                logger.warning(
+                    f"Commit invoked for unknown transaction {transactional_id}"
+                )
 
     def _settings_extra(self) -> Mapping[str, Any]:
         if self.app.in_transaction:
@@ -1249,14 +1637,16 @@ class Producer(base.Producer):
         self, transactional_id: Optional[str] = None
     ) -> aiokafka.AIOKafkaProducer:
         return self._producer_type(
-            **{
-                **self._settings_default(),
-                **self._settings_auth(),
-                **self._settings_extra(),
-            },
+            **{**self._settings_base, **self._settings_extra()},
             transactional_id=transactional_id,
         )
 
+    @cached_property
+    def _settings_base(self) -> Mapping[str, Any]:
+        # Configuration does not change after the producer is created,
+        # so avoid rebuilding this for every new transaction producer.
+        return {**self._settings_default(), **self._settings_auth()}
+
     @property
     def _producer_type(self) -> Type[aiokafka.AIOKafkaProducer]:
         return aiokafka.AIOKafkaProducer
@@ -1303,6 +1693,9 @@ class Producer(base.Producer):
     async def on_start(self) -> None:
         """Call when producer starts."""
         await super().on_start()
+        max_inflight = self.app.conf.producer_max_inflight_messages
+        if max_inflight and self._inflight is None:
+            self._inflight = asyncio.Semaphore(max_inflight)
         producer = self._producer = self._new_producer()
         self.beacon.add(producer)
         await producer.start()
@@ -1338,34 +1731,32 @@ class Producer(base.Producer):
                 raise ProducerSendError(
                     f"No transaction producer found for : {transactional_id}"
                 )
-        if headers is not None:
+        if headers is not None and type(headers) is not list:
             if isinstance(headers, Mapping):
                 headers = list(headers.items())
-        self._send_on_produce_message(
-            key=key,
-            value=value,
-            partition=partition,
-            timestamp=timestamp,
-            headers=headers,
-        )
+        receivers = self._produce_message_receivers
+        if receivers is None or receivers or self._produce_message_filter_receivers:
+            self._send_on_produce_message(
+                key=key,
+                value=value,
+                partition=partition,
+                timestamp=timestamp,
+                headers=headers,
+            )
         if headers is not None and not self.allow_headers:
             headers = None
-        timestamp_ms = int(timestamp * 1000.0) if timestamp else timestamp
-        try:
-            if transactional_id:
-                async with self._trn_locks[transactional_id]:
-                    return cast(
-                        Awaitable[RecordMetadata],
-                        await transaction_producer.send(
-                            topic,
-                            value,
-                            key=key,
-                            partition=partition,
-                            timestamp_ms=timestamp_ms,
-                            headers=headers,
-                        ),
-                    )
-            else:
+        if not timestamp:
+            timestamp_ms = timestamp
+        elif type(timestamp) is int:
+            # whole seconds: stay in integer arithmetic
+            timestamp_ms = timestamp * 1000
+        else:
+            timestamp_ms = int(timestamp * 1000.0)
+        inflight = self._inflight
+        if inflight is None and not transactional_id:
+            # Common case: no transaction lock to take and
+            # no limit on unacknowledged messages to keep track of.
+            try:
                 return cast(
                     Awaitable[RecordMetadata],
                     await transaction_producer.send(
@@ -1377,9 +1768,47 @@ class Producer(base.Producer):
                         headers=headers,
                     ),
                 )
-
+            except KafkaError as exc:
+                raise ProducerSendError(f"Error while sending: {exc!r}") from exc
+        if inflight is not None:
+            # wait for earlier messages to be acknowledged
+            await inflight.acquire()
+        fut: Optional[asyncio.Future] = None
+        try:
+            if transactional_id:
+                # Agents send while the consumer commits on the same
+                # transactional id, so the lock is what keeps messages out
+                # of a transaction that is being committed.
+                async with self._trn_locks[transactional_id]:
+                    fut = await transaction_producer.send(
+                        topic,
+                        value,
+                        key=key,
+                        partition=partition,
+                        timestamp_ms=timestamp_ms,
+                        headers=headers,
+                    )
+            else:
+                fut = await transaction_producer.send(
+                    topic,
+                    value,
+                    key=key,
+                    partition=partition,
+                    timestamp_ms=timestamp_ms,
+                    headers=headers,
+                )
         except KafkaError as exc:
             raise ProducerSendError(f"Error while sending: {exc!r}") from exc
+        finally:
+            if inflight is not None:
+                if fut is None:
+                    inflight.release()
+                else:
+                    fut.add_done_callback(self._on_inflight_done)
+        return cast(Awaitable[RecordMetadata], fut)
+
+    def _on_inflight_done(self, fut: asyncio.Future) -> None:
+        cast(asyncio.Semaphore, self._inflight).release()
 
     async def send_and_wait(
         self,
@@ -1446,11 +1875,64 @@ class Transport(base.Transport):
     driver_version = f"aiokafka={aiokafka.__version__}"
 
     _topic_waiters: MutableMapping[str, StampedeWrapper]
+    _controller_node: Optional[int] = None
+    _controller_node_expires: float = 0.0
 
     def __init__(self, *args: Any, **kwargs: Any) -> None:
         super().__init__(*args, **kwargs)
         self._topic_waiters = {}
 
+    @cached_property
+    def bootstrap_servers(self) -> List[str]:
+        """Bootstrap servers for :pypi:`aiokafka` clients created by us."""
+        return server_list(self.url, self.default_port)
+
+    @cached_property
+    def worker_consumer_settings(self) -> Mapping[str, Any]:
+        """Configuration-derived arguments for the worker consumer.
+
+        These only depend on the app configuration, so they are
+        validated and converted once, not every time the
+        consumer thread creates a new consumer.
+        """
+        conf = self.app.conf
+        max_poll_interval = conf.broker_max_poll_interval or 0
+
+        request_timeout = conf.broker_request_timeout
+        session_timeout = conf.broker_session_timeout
+        rebalance_timeout = conf.broker_rebalance_timeout
+
+        if session_timeout > request_timeout:
+            raise ImproperlyConfigured(
+                f"Setting broker_session_timeout={session_timeout} "
+                f"cannot be greater than "
+                f"broker_request_timeout={request_timeout}"
+            )
+
+        return {
+            "api_version": conf.consumer_api_version,
+            "client_id": conf.broker_client_id,
+            "group_id": conf.id,
+            "group_instance_id": conf.consumer_group_instance_id,
+            "bootstrap_servers": self.bootstrap_servers,
+            "enable_auto_commit": False,
+            "auto_offset_reset": conf.consumer_auto_offset_reset,
+            "max_poll_records": conf.broker_max_poll_records,
+            "max_poll_interval_ms": int(max_poll_interval * 1000.0),
+            "max_partition_fetch_bytes": conf.consumer_max_fetch_size,
+            "fetch_max_bytes": conf.broker_fetch_max_bytes,
+            "fetch_min_bytes": conf.broker_fetch_min_bytes,
+            "fetch_max_wait_ms": int(conf.broker_fetch_max_wait * 1000.0),
+            "request_timeout_ms": int(request_timeout * 1000.0),
+            "check_crcs": conf.broker_check_crcs,
+            "session_timeout_ms": int(session_timeout * 1000.0),
+            "rebalance_timeout_ms": int(rebalance_timeout * 1000.0),
+            "heartbeat_interval_ms": int(conf.broker_heartbeat_interval * 1000.0),
+            "metadata_max_age_ms": conf.consumer_metadata_max_age_ms,
+            "connections_max_idle_ms": conf.consumer_connections_max_idle_ms,
+            **credentials_to_aiokafka_auth(conf.broker_credentials, conf.ssl_context),
+        }
+
     def _topic_config(
         self,
         retention: Optional[int] = None,
@@ -1501,21 +1983,30 @@ class Transport(base.Transport):
     async def _get_controller_node(
         self, owner: Service, client: aiokafka.AIOKafkaClient, timeout: int = 30000
     ) -> Optional[int]:  # pragma: no cover
-        nodes = [broker.nodeId for broker in client.cluster.brokers()]
-        for node_id in nodes:
-            if node_id is None:
-                raise NotReady("Not connected to Kafka Broker")
-            request = MetadataRequest_v1([])
-            wait_result = await owner.wait(
-                client.send(node_id, request),
-                timeout=timeout,
-            )
-            if wait_result.stopped:
-                owner.log.info("Shutting down - skipping creation.")
-                return None
-            response = wait_result.result
-            return response.controller_id
-        raise Exception("Controller node not found")
+        now = monotonic()
+        if self._controller_node is not None and now < self._controller_node_expires:
+            # creating many topics at startup should not ask for
+            # the controller every time.
+            return self._controller_node
+        # any broker can tell us which one is the controller.
+        broker = next(iter(client.cluster.brokers()), None)
+        if broker is None:
+            raise Exception("Controller node not found")
+        node_id = broker.nodeId
+        if node_id is None:
+            raise NotReady("Not connected to Kafka Broker")
+        wait_result = await owner.wait(
+            client.send(node_id, _METADATA_REQUEST_NO_TOPICS),
+            timeout=timeout,
+        )
+        if wait_result.stopped:
+            owner.log.info("Shutting down - skipping creation.")
+            return None
+        controller_node = wait_result.result.controller_id
+        self._controller_node = controller_node
+        max_age = self.app.conf.consumer_metadata_max_age_ms / 1000.0
+        self._controller_node_expires = now + max_age
+        return controller_node
 
     async def _really_create_topic(
         self,
@@ -1578,6 +2069,7 @@ class Transport(base.Transport):
                 owner.log.debug("Topic %r exists, skipping creation.", topic)
                 return
             elif code == NotControllerError.errno:
+                self._controller_node = None
                 raise RuntimeError(f"Invalid controller: {controller_node}")
             else:
                 raise for_code(code)(f"Cannot create topic: {topic} ({code}): {reason}")
@@ -1586,58 +2078,107 @@ class Transport(base.Transport):
             return
 
 
+#: Reads ``(protocol.value, mechanism.value)`` off SASL credentials
+#: in a single C-level call.
+_sasl_enum_values = attrgetter("protocol.value", "mechanism.value")
+
+
+def _ssl_auth(credentials: SSLCredentials) -> Mapping[str, Any]:
+    return {
+        "security_protocol": credentials.protocol.value,
+        "ssl_context": credentials.context,
+    }
+
+
+def _oauth_auth(credentials: OAuthCredentials) -> Mapping[str, Any]:
+    protocol, mechanism = _sasl_enum_values(credentials)
+    return {
+        "security_protocol": protocol,
+        "sasl_mechanism": mechanism,
+        "sasl_oauth_token_provider": credentials.oauth_cb,
+        "ssl_context": credentials.ssl_context,
+    }
+
+
+def _sasl_auth(credentials: SASLCredentials) -> Mapping[str, Any]:
+    protocol, mechanism = _sasl_enum_values(credentials)
+    return {
+        "security_protocol": protocol,
+        "sasl_mechanism": mechanism,
+        "sasl_plain_username": credentials.username,
+        "sasl_plain_password": credentials.password,
+        "ssl_context": credentials.ssl_context,
+    }
+
+
+def _gssapi_auth(credentials: GSSAPICredentials) -> Mapping[str, Any]:
+    protocol, mechanism = _sasl_enum_values(credentials)
+    return {
+        "security_protocol": protocol,
+        "sasl_mechanism": mechanism,
+        "sasl_kerberos_service_name": credentials.kerberos_service_name,
+        "sasl_kerberos_domain_name": credentials.kerberos_domain_name,
+        "ssl_context": credentials.ssl_context,
+    }
+
+
+#: Credentials type to aiokafka auth arguments.
+#: Order matters for subclasses: the first matching type wins.
+_AUTH_BUILDERS: Mapping[type, Callable[[Any], Mapping[str, Any]]] = {
+    SSLCredentials: _ssl_auth,
+    OAuthCredentials: _oauth_auth,
+    SASLCredentials: _sasl_auth,
+    GSSAPICredentials: _gssapi_auth,
+}
+
+
+def _subclass_auth_builder(
+    credentials: CredentialsT,
+) -> Callable[[Any], Mapping[str, Any]]:
+    for credentials_type, builder in _AUTH_BUILDERS.items():
+        if isinstance(credentials, credentials_type):
+            return builder
+    raise ImproperlyConfigured(f"aiokafka does not support {credentials}")
+
+
+#: Auth arguments used when there are no credentials and no SSL context.
+_PLAINTEXT_AUTH: Mapping[str, Any] = {"security_protocol": "PLAINTEXT"}
+
+
 def credentials_to_aiokafka_auth(
     credentials: Optional[CredentialsT] = None, ssl_context: Any = None
 ) -> Mapping:
     if credentials is not None:
-        if isinstance(credentials, SSLCredentials):
-            return {
-                "security_protocol": credentials.protocol.value,
-                "ssl_context": credentials.context,
-            }
-        elif isinstance(credentials, OAuthCredentials):
-            return {
-                "security_protocol": credentials.protocol.value,
-                "sasl_mechanism": credentials.mechanism.value,
-                "sasl_oauth_token_provider": credentials.oauth_cb,
-                "ssl_context": credentials.ssl_context,
-            }
-        elif isinstance(credentials, SASLCredentials):
-            return {
-                "security_protocol": credentials.protocol.value,
-                "sasl_mechanism": credentials.mechanism.value,
-                "sasl_plain_username": credentials.username,
-                "sasl_plain_password": credentials.password,
-                "ssl_context": credentials.ssl_context,
-            }
-        elif isinstance(credentials, GSSAPICredentials):
-            return {
-                "security_protocol": credentials.protocol.value,
-                "sasl_mechanism": credentials.mechanism.value,
-                "sasl_kerberos_service_name": credentials.kerberos_service_name,
-                "sasl_kerberos_domain_name": credentials.kerberos_domain_name,
-                "ssl_context": credentials.ssl_context,
-            }
-        else:
-            raise ImproperlyConfigured(f"aiokafka does not support {credentials}")
+        builder = _AUTH_BUILDERS.get(type(credentials))
+        if builder is None:
+            builder = _subclass_auth_builder(credentials)
+        return builder(credentials)
     elif ssl_context is not None:
         return {
             "security_protocol": "SSL",
             "ssl_context": ssl_context,
         }
     else:
-        return {"security_protocol": "PLAINTEXT"}
+        # copy, so callers are free to modify what they get.
+        return dict(_PLAINTEXT_AUTH)
 
 
 def ensure_aiokafka_TP(tp: TP) -> _TopicPartition:
     """Convert Faust ``TP`` to aiokafka ``TopicPartition``."""
-    return (
-        tp
-        if isinstance(tp, _TopicPartition)
-        else _TopicPartition(tp.topic, tp.partition)
-    )
+    # exact type check: subclasses of the aiokafka tuple are rebuilt,
+    # and both tuple types unpack positionally as (topic, partition).
+    return tp if type(tp) is _TopicPartition else _TopicPartition(tp[0], tp[1])
 
 
 def ensure_aiokafka_TPset(tps: Iterable[TP]) -> Set[_TopicPartition]:
-    """Convert set of Faust ``TP`` to aiokafka ``TopicPartition``."""
-    return {ensure_aiokafka_TP(tp) for tp in tps}
+    """Convert set of Faust ``TP`` to aiokafka ``TopicPartition``.
+
+    Always returns a new set, also when ``tps`` is already a set
+    of aiokafka ``TopicPartition``, so callers are free to mutate it.
+    Sets are assumed to hold a single type, so only one element
+    is checked to decide whether the set needs converting.
+    """
+    if type(tps) is set and (not tps or type(next(iter(tps))) is _TopicPartition):
+        # nothing to convert: copying a set reuses the stored hashes.
+        return set(tps)
+    return set(map(ensure_aiokafka_TP, tps))
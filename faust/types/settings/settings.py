@@ -95,16 +95,24 @@ class Settings(base.SettingsRegistry):
         broker_api_version: Optional[str] = None,
         broker_check_crcs: Optional[bool] = None,
         broker_client_id: Optional[str] = None,
+        broker_commit_async: Optional[bool] = None,
         broker_commit_every: Optional[int] = None,
         broker_commit_interval: Optional[Seconds] = None,
+        broker_commit_linger: Optional[Seconds] = None,
         broker_commit_livelock_soft_timeout: Optional[Seconds] = None,
+        broker_commit_refresh_interval: Optional[Seconds] = None,
         broker_credentials: CredentialsArg = None,
+        broker_fetch_max_bytes: Optional[int] = None,
+        broker_fetch_max_wait: Optional[Seconds] = None,
+        broker_fetch_min_bytes: Optional[int] = None,
         broker_heartbeat_interval: Optional[Seconds] = None,
         broker_max_poll_interval: Optional[Seconds] = None,
         broker_max_poll_records: Optional[int] = None,
+        broker_max_poll_records_target_latency: Optional[Seconds] = None,
         broker_rebalance_timeout: Optional[Seconds] = None,
         broker_request_timeout: Optional[Seconds] = None,
         broker_session_timeout: Optional[Seconds] = None,
+        broker_use_sticky_assignor: Optional[bool] = None,
         ssl_context: ssl.SSLContext = None,
         # Consumer settings:
         consumer_api_version: Optional[str] = None,
@@ -123,8 +131,10 @@ class Settings(base.SettingsRegistry):
         producer_acks: Optional[int] = None,
         producer_api_version: Optional[str] = None,
         producer_compression_type: Optional[str] = None,
+        producer_linger_autotune: Optional[bool] = None,
         producer_linger_ms: Optional[int] = None,
         producer_max_batch_size: Optional[int] = None,
+        producer_max_inflight_messages: Optional[int] = None,
         producer_max_request_size: Optional[int] = None,
         producer_partitioner: SymbolArg[PartitionerT] = None,
         producer_request_timeout: Optional[Seconds] = None,
@@ -781,6 +791,11 @@ class Settings(base.SettingsRegistry):
         """Broker CRC check.
 
         Automatically check the CRC32 of the records consumed.
+
+        This guards against records corrupted on the wire or on disk,
+        and :pypi:`aiokafka` computes it with its C extension when available.
+        Disabling it saves some CPU when fetching on high throughput topics,
+        but corrupted records will then be passed on to your agents.
         """
 
     @sections.Broker.setting(
@@ -797,6 +812,26 @@ class Settings(base.SettingsRegistry):
         configured by the user.
         """
 
+    @sections.Broker.setting(
+        params.Bool,
+        env_name="BROKER_COMMIT_ASYNC",
+        default=False,
+    )
+    def broker_commit_async(self) -> bool:
+        """Broker asynchronous commit.
+
+        When enabled offset commits are sent to the broker in the
+        background and the consumer does not wait for the broker
+        to acknowledge them, similar to ``commitAsync`` in the Java client.
+
+        Commit errors are still logged and will crash the consumer,
+        but the commit call itself returns as soon as the request
+        is scheduled.
+
+        Leave this disabled if you need every commit to be confirmed
+        before processing continues.
+        """
+
     @sections.Broker.setting(
         params.UnsignedInt,
         env_name="BROKER_COMMIT_EVERY",
@@ -823,6 +858,29 @@ class Settings(base.SettingsRegistry):
         fully processed (:term:`acked`).
         """
 
+    @sections.Broker.setting(
+        params.Seconds,
+        env_name="BROKER_COMMIT_LINGER",
+        default=0.0,
+    )
+    def broker_commit_linger(self) -> float:
+        """Broker commit linger.
+
+        How long (in seconds) to wait for more commits before sending
+        them to the broker.
+
+        Offsets committed within this window are merged (keeping the
+        highest offset for every partition) and sent as a single
+        offset commit request.
+
+        Synchronous commits wait for the broker one at a time,
+        so there is nothing to merge and this setting is ignored
+        unless :setting:`broker_commit_async` is enabled.
+
+        The default of ``0.0`` disables this and sends every commit
+        as soon as it's made.
+        """
+
     @sections.Broker.setting(
         params.Seconds,
         env_name="BROKER_COMMIT_LIVELOCK_SOFT_TIMEOUT",
@@ -835,6 +893,28 @@ class Settings(base.SettingsRegistry):
         not advanced (only when processing messages).
         """
 
+    @sections.Broker.setting(
+        params.Seconds,
+        env_name="BROKER_COMMIT_REFRESH_INTERVAL",
+        default=0.0,
+    )
+    def broker_commit_refresh_interval(self) -> float:
+        """Broker commit refresh interval.
+
+        How often (in seconds) to commit the last committed offset of
+        every assigned partition again, even when no new messages have
+        been processed.
+
+        Brokers older than Kafka 2.1 expire committed offsets after
+        ``offsets.retention.minutes``, even for consumer groups that
+        are still active.  A partition that sees no traffic for that long
+        then loses its offset, and the worker restarts it from
+        :setting:`consumer_auto_offset_reset`.  Set this to well below
+        the retention time if you use such brokers.
+
+        The default of ``0.0`` disables this.
+        """
+
     @sections.Common.setting(
         params.Credentials,
         version_introduced="1.5",
@@ -926,6 +1006,55 @@ class Settings(base.SettingsRegistry):
                 app = faust.App(..., broker_credentials=ssl_context)
         """
 
+    @sections.Broker.setting(
+        params.UnsignedInt,
+        env_name="BROKER_FETCH_MAX_BYTES",
+        default=52428800,
+    )
+    def broker_fetch_max_bytes(self) -> int:
+        """Broker fetch max bytes.
+
+        The maximum amount of data the server will return for a single
+        fetch request, across all partitions.
+
+        Together with :setting:`consumer_max_fetch_size` (the per-partition
+        limit) this bounds how much fetched data the consumer will buffer
+        in memory while catching up on many partitions.
+        """
+
+    @sections.Broker.setting(
+        params.Seconds,
+        env_name="BROKER_FETCH_MAX_WAIT",
+        default=1.5,
+    )
+    def broker_fetch_max_wait(self) -> float:
+        """Broker fetch max wait.
+
+        How long (in seconds) the server will block a fetch request
+        if there isn't enough data to satisfy
+        :setting:`broker_fetch_min_bytes`.
+
+        Lower this for latency sensitive applications
+        that also raise :setting:`broker_fetch_min_bytes`.
+        """
+
+    @sections.Broker.setting(
+        params.UnsignedInt,
+        env_name="BROKER_FETCH_MIN_BYTES",
+        default=1,
+    )
+    def broker_fetch_min_bytes(self) -> int:
+        """Broker fetch min bytes.
+
+        The minimum amount of data the server should return for a fetch
+        request, otherwise it waits up to :setting:`broker_fetch_max_wait`
+        for more data to accumulate.
+
+        The default of ``1`` returns data as soon as any is available.
+        Raising this means fewer, larger fetches for high throughput
+        consumers, at the cost of added latency.
+        """
+
     @sections.Broker.setting(
         params.Seconds,
         version_introduced="1.0.11",
@@ -979,6 +1108,27 @@ class Settings(base.SettingsRegistry):
         loop iteration.
         """
 
+    @sections.Broker.setting(
+        params.Seconds,
+        env_name="BROKER_MAX_POLL_RECORDS_TARGET_LATENCY",
+        default=0.0,
+    )
+    def broker_max_poll_records_target_latency(self) -> float:
+        """Broker max poll records target latency.
+
+        How long (in seconds) the worker should spend handling the records
+        returned by a single poll.  When set together with
+        :setting:`broker_max_poll_records`, the number of records asked for in
+        every poll is adjusted from how long recent batches took to be handed
+        over to streams: it shrinks while the streams fall behind and grows back
+        up to :setting:`broker_max_poll_records` once they keep up.
+
+        Smaller values lower latency at the cost of more, smaller fetches.
+
+        The default of ``0.0`` disables this, and every poll asks for
+        :setting:`broker_max_poll_records` records.
+        """
+
     @sections.Broker.setting(
         params.Seconds,
         version_introduced="1.10",
@@ -1038,6 +1188,26 @@ class Settings(base.SettingsRegistry):
             :setting:`broker_request_timeout`.
         """
 
+    @sections.Broker.setting(
+        params.Bool,
+        env_name="BROKER_USE_STICKY_ASSIGNOR",
+        default=False,
+    )
+    def broker_use_sticky_assignor(self) -> bool:
+        """Use sticky partition assignment.
+
+        When enabled, and :setting:`table_standby_replicas` is zero,
+        the consumer uses :pypi:`aiokafka`'s sticky partition assignor
+        instead of round-robin.
+
+        The sticky assignor keeps partitions on the worker that already
+        owns them, so a worker joining or leaving the group only moves
+        the partitions that have to move instead of reshuffling them all.
+
+        Note that all members of the consumer group must use the same
+        assignor.
+        """
+
     @sections.Common.setting(
         params.SSLContext,
         default=None,
@@ -1276,6 +1446,32 @@ class Settings(base.SettingsRegistry):
     def _prepare_producer_linger(self) -> float:
         return float(self._producer_linger_ms) / 1000.0
 
+    @sections.Producer.setting(
+        params.Bool,
+        env_name="PRODUCER_LINGER_AUTOTUNE",
+        default=False,
+    )
+    def producer_linger_autotune(self) -> bool:
+        """Producer linger autotuning.
+
+        When enabled with :setting:`producer_threaded`, the threaded
+        producer checks its buffer every second and lowers the linger
+        time as messages back up, down to zero when a thousand or more
+        messages are waiting.  Once the buffer drains the linger time
+        goes back to :setting:`producer_linger`.
+
+        This trades some batching for lower latency during bursts
+        and is disabled by default.
+
+        .. warning::
+
+            :pypi:`aiokafka` has no public API to change the linger time
+            of a running producer, so this relies on aiokafka internals.
+            It is tested with aiokafka 0.10 to 0.14; with versions where
+            those internals are missing, a warning is logged and
+            the linger time is left unchanged.
+        """
+
     @sections.Producer.setting(
         params.UnsignedInt,
         env_name="PRODUCER_MAX_BATCH_SIZE",
@@ -1287,6 +1483,26 @@ class Settings(base.SettingsRegistry):
         Max size of each producer batch, in bytes.
         """
 
+    @sections.Producer.setting(
+        params.UnsignedInt,
+        env_name="PRODUCER_MAX_INFLIGHT_MESSAGES",
+        default=0,
+    )
+    def producer_max_inflight_messages(self) -> int:
+        """Maximum number of unacknowledged messages.
+
+        When set, sending a message waits until fewer than this many
+        messages sent earlier are still waiting to be acknowledged
+        by the broker.  This pushes back on producers that send faster
+        than the broker can keep up with, instead of letting the
+        producer buffer grow and batches get larger and slower.
+
+        A good value is a few times :setting:`producer_max_batch_size`
+        divided by the typical message size.
+
+        The default of zero does not limit the number of messages.
+        """
+
     @sections.Producer.setting(
         params.UnsignedInt,
         env_name="PRODUCER_MAX_REQUEST_SIZE",
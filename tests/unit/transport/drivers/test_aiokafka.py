@@ -1,5 +1,7 @@
+import asyncio
 import random
 import string
+import threading
 from contextlib import contextmanager
 from typing import Optional
 from unittest.mock import ANY, MagicMock, Mock, call, patch
@@ -7,12 +9,22 @@ from unittest.mock import ANY, MagicMock, Mock, call, patch
 import aiokafka
 import opentracing
 import pytest
-from aiokafka.errors import CommitFailedError, IllegalStateError, KafkaError
+from aiokafka import partitioner as aiokafka_partitioner
+from aiokafka.coordinator.assignors.sticky.sticky_assignor import (
+    StickyPartitionAssignor,
+)
+from aiokafka.errors import (
+    CommitFailedError,
+    IllegalStateError,
+    KafkaError,
+    ProducerFenced,
+)
 from aiokafka.structs import OffsetAndMetadata, TopicPartition
 from mode.utils import text
 from mode.utils.futures import done_future
 from mode.utils.times import humanize_seconds_ago
 from opentracing.ext import tags
+from yarl import URL
 
 import faust
 from faust import auth
@@ -35,6 +47,7 @@ from faust.transport.drivers.aiokafka import (
     ThreadedProducer,
     Transport,
     credentials_to_aiokafka_auth,
+    ensure_aiokafka_TP,
     ensure_aiokafka_TPset,
     server_list,
 )
@@ -220,6 +233,26 @@ class TestConsumer:
         m = consumer._to_message(TopicPartition("t", 3), record)
         assert m.timestamp is None
 
+    def test__message_converter(self, *, consumer):
+        tp = TopicPartition("t", 3)
+        consumer.app.consumer_generation_id = 7
+        records = [
+            self.mock_record(timestamp=3000, offset=1001),
+            self.mock_record(timestamp=None, offset=1002),
+        ]
+        to_message = consumer._message_converter(tp)
+        messages = [to_message(record) for record in records]
+        assert [m.offset for m in messages] == [1001, 1002]
+        assert messages[0].timestamp == 3.0
+        assert messages[1].timestamp is None
+        for m, record in zip(messages, records):
+            assert m.tp == tp
+            assert m.generation_id == 7
+            assert m.key == record.key
+            assert m.value == record.value
+            assert m.headers == record.headers
+            assert m.checksum == record.checksum
+
     def mock_record(
         self,
         topic="t",
@@ -413,6 +446,14 @@ class Test_verify_event_path_base(AIOKafkaConsumerThreadFixtures):
         assert cthread.time_started == now
 
 
+class Test_VEP_reuses_aiokafka_tp(Test_verify_event_path_base):
+    def test_state_value_receives_cached_tp(self, *, cthread, _consumer, now, tp):
+        aiotp = cthread._aiokafka_tp(tp)
+        cthread.verify_event_path(now, tp)
+        assignment = _consumer._fetcher._subscriptions.subscription.assignment
+        assert assignment.state_value.call_args[0][0] is aiotp
+
+
 class Test_Log_Slow_Processing(Test_verify_event_path_base):
     def test_log_slow_processing_stream(
         self, cthread: AIOKafkaConsumerThread, tp: TP, logger
@@ -693,7 +734,10 @@ class Test_VEP_no_commit(Test_verify_event_path_base):
         assert cthread.verify_event_path(now, tp) is None
         expected_message = cthread._make_slow_processing_error(
             mod.SLOW_PROCESSING_NO_COMMIT_SINCE_START,
-            [mod.SLOW_PROCESSING_CAUSE_COMMIT],
+            [
+                mod.SLOW_PROCESSING_CAUSE_COMMIT,
+                mod.SLOW_PROCESSING_CAUSE_COMMIT_SLOW,
+            ],
             setting="broker_commit_livelock_soft_timeout",
             current_value=app.conf.broker_commit_livelock_soft_timeout,
         )
@@ -710,7 +754,10 @@ class Test_VEP_no_commit(Test_verify_event_path_base):
         assert cthread.verify_event_path(now, tp) is None
         expected_message = cthread._make_slow_processing_error(
             mod.SLOW_PROCESSING_NO_RECENT_COMMIT,
-            [mod.SLOW_PROCESSING_CAUSE_COMMIT],
+            [
+                mod.SLOW_PROCESSING_CAUSE_COMMIT,
+                mod.SLOW_PROCESSING_CAUSE_COMMIT_SLOW,
+            ],
             setting="broker_commit_livelock_soft_timeout",
             current_value=app.conf.broker_commit_livelock_soft_timeout,
         )
@@ -744,6 +791,9 @@ class Test_AIOKafkaConsumerThread(AIOKafkaConsumerThreadFixtures):
         assert cthread._consumer is cthread._create_consumer.return_value
         cthread._create_consumer.assert_called_once_with(loop=cthread.thread_loop)
         cthread._consumer.start.assert_called_once_with()
+        cthread._consumer._client.cluster.add_listener.assert_called_once_with(
+            cthread._on_metadata_change
+        )
 
     @pytest.mark.asyncio
     async def test_on_thread_stop(self, *, cthread, _consumer):
@@ -751,6 +801,19 @@ class Test_AIOKafkaConsumerThread(AIOKafkaConsumerThreadFixtures):
         await cthread.on_thread_stop()
         cthread._consumer.stop.assert_called_once_with()
 
+    @pytest.mark.asyncio
+    async def test_on_thread_stop__flushes_lingering_commits(
+        self, *, cthread, _consumer
+    ):
+        cthread._consumer = _consumer
+        cthread._add_pending_commit({TP1: OffsetAndMetadata(1001, "")}, 10.0)
+        await cthread.on_thread_stop()
+        _consumer.commit.assert_called_once_with(
+            {TP1: OffsetAndMetadata(1001, "")},
+        )
+        _consumer.stop.assert_called_once_with()
+        assert cthread._commit_flush_handle is None
+
     @pytest.mark.asyncio
     async def test_on_thread_stop__consumer_not_started(self, *, cthread):
         cthread._consumer = None
@@ -787,6 +850,80 @@ class Test_AIOKafkaConsumerThread(AIOKafkaConsumerThreadFixtures):
             isolation_level="read_uncommitted",
         )
 
+    def test__aiokafka_tp(self, *, cthread):
+        aiotp = cthread._aiokafka_tp(TP1)
+        assert aiotp == TopicPartition(TP1.topic, TP1.partition)
+        assert isinstance(aiotp, TopicPartition)
+        assert cthread._aiokafka_tp(TP1) is aiotp
+
+    @pytest.mark.asyncio
+    async def test_on_partitions_revoked__drops_aiokafka_tps(self, *, cthread):
+        cthread.consumer.threadsafe_partitions_revoked = AsyncMock()
+        cthread._aiokafka_tp(TP1)
+        cthread._aiokafka_tp(TP2)
+        await cthread.on_partitions_revoked({TP1})
+        assert TP1 not in cthread._aiokafka_tps
+        assert TP2 in cthread._aiokafka_tps
+        cthread.consumer.threadsafe_partitions_revoked.assert_called_once_with(
+            cthread.thread_loop, {TP1}
+        )
+
+    @pytest.mark.asyncio
+    async def test_on_partitions_revoked__waits_for_async_commits(
+        self, *, cthread, _consumer
+    ):
+        cthread._consumer = _consumer
+        cthread.assignment = Mock(return_value={TP1})
+        cthread.app.conf.broker_commit_async = True
+
+        async def on_revoked(loop, revoked):
+            # the commit issued on revoke doesn't wait for the broker.
+            assert await cthread._commit({TP1: 1001})
+            _consumer.commit.assert_not_called()
+
+        cthread.consumer.threadsafe_partitions_revoked = on_revoked
+        await cthread.on_partitions_revoked({TP1})
+        _consumer.commit.assert_called_once_with(
+            {TP1: OffsetAndMetadata(1001, "")},
+        )
+        assert not cthread._commit_tasks
+
+    @pytest.mark.asyncio
+    async def test_on_partitions_revoked__flushes_lingering_commits(
+        self, *, cthread, _consumer
+    ):
+        cthread._consumer = _consumer
+        cthread.assignment = Mock(return_value={TP1})
+        cthread.app.conf.broker_commit_async = True
+        cthread.app.conf.broker_commit_linger = 10.0
+        cthread.consumer.threadsafe_partitions_revoked = AsyncMock()
+        assert await cthread._commit({TP1: 1001})
+        _consumer.commit.assert_not_called()
+
+        await cthread.on_partitions_revoked({TP1})
+        _consumer.commit.assert_called_once_with(
+            {TP1: OffsetAndMetadata(1001, "")},
+        )
+        assert cthread._commit_flush_handle is None
+        assert not cthread._commit_tasks
+
+    def test__commit__linger_schedules_on_thread_loop(self, *, cthread):
+        cthread.thread_loop = Mock(name="thread_loop")
+        cthread._add_pending_commit({TP1: OffsetAndMetadata(1001, "")}, 10.0)
+        cthread.thread_loop.call_later.assert_called_once_with(
+            10.0, cthread._flush_commits
+        )
+        assert (
+            cthread._commit_flush_handle is cthread.thread_loop.call_later.return_value
+        )
+
+    def test__create_worker_consumer__sticky_assignor(self, *, cthread, app):
+        app.conf.broker_use_sticky_assignor = True
+        app.conf.table_standby_replicas = 0
+        with patch("aiokafka.AIOKafkaConsumer"):
+            cthread._create_worker_consumer(cthread.transport)
+        assert cthread._assignor is StickyPartitionAssignor
+
     def test__create_worker_consumer__transaction(self, *, cthread, app):
         self.assert_create_worker_consumer(
             cthread,
@@ -825,7 +962,9 @@ class Test_AIOKafkaConsumerThread(AIOKafkaConsumerThreadFixtures):
                 max_poll_records=conf.broker_max_poll_records,
                 max_poll_interval_ms=int(max_poll_interval * 1000.0),
                 max_partition_fetch_bytes=conf.consumer_max_fetch_size,
-                fetch_max_wait_ms=1500,
+                fetch_max_bytes=conf.broker_fetch_max_bytes,
+                fetch_min_bytes=conf.broker_fetch_min_bytes,
+                fetch_max_wait_ms=int(conf.broker_fetch_max_wait * 1000.0),
                 request_timeout_ms=int(conf.broker_request_timeout * 1000.0),
                 rebalance_timeout_ms=int(conf.broker_rebalance_timeout * 1000.0),
                 check_crcs=conf.broker_check_crcs,
@@ -895,7 +1034,7 @@ class Test_AIOKafkaConsumerThread(AIOKafkaConsumerThreadFixtures):
         assert len(pending) == 3
 
         cthread.on_generation_id_known()
-        assert not pending
+        assert not cthread._pending_rebalancing_spans
 
     @pytest.mark.skip("Needs fixing")
     def test_transform_span_flush_spans(self, *, cthread, app, tracer):
@@ -906,7 +1045,52 @@ class Test_AIOKafkaConsumerThread(AIOKafkaConsumerThreadFixtures):
         assert len(pending) == 3
 
         cthread.flush_spans()
-        assert not pending
+        assert not cthread._pending_rebalancing_spans
+
+    def test__transform_span_lazy(self, *, cthread):
+        span = Mock(name="span")
+        finish = span.finish
+        span_type = type(span)
+        cthread._span_finish = Mock()
+        cthread._transform_span_lazy(span)
+        assert span._real_finish is finish
+        assert type(span) is span_type
+        span.finish()
+        cthread._span_finish.assert_called_once_with(span)
+        finish.assert_not_called()
+
+    def test__rebalance_trace_id(self, *, cthread):
+        trace_id = cthread._rebalance_trace_id("app", 3)
+        assert trace_id == mod.murmur2(b"reb-app-3")
+        with patch(TESTED_MODULE + ".murmur2") as murmur2:
+            assert cthread._rebalance_trace_id("app", 3) == trace_id
+            murmur2.assert_not_called()
+
+    def test__rebalance_trace_id__bounded(self, *, cthread):
+        cthread.max_rebalance_trace_ids = 2
+        for generation in range(4):
+            cthread._rebalance_trace_id("app", generation)
+        assert list(cthread._rebalance_trace_ids) == [2, 3]
+
+    def test_flush_spans(self, *, cthread):
+        spans = [Mock(name="span1"), Mock(name="span2")]
+        cthread._pending_rebalancing_spans.extend(spans)
+        cthread._on_span_cancelled_early = Mock()
+        cthread.flush_spans()
+        cthread._on_span_cancelled_early.assert_has_calls(
+            [call(span) for span in spans]
+        )
+        assert not cthread._pending_rebalancing_spans
+
+    def test_on_generation_id_known(self, *, cthread):
+        spans = [Mock(name="span1"), Mock(name="span2")]
+        cthread._pending_rebalancing_spans.extend(spans)
+        cthread._on_span_generation_known = Mock()
+        cthread.on_generation_id_known()
+        cthread._on_span_generation_known.assert_has_calls(
+            [call(span) for span in spans]
+        )
+        assert not cthread._pending_rebalancing_spans
 
     def test_span_without_operation_name(self, *, cthread):
         span = opentracing.Span(
@@ -1025,6 +1209,35 @@ class Test_AIOKafkaConsumerThread(AIOKafkaConsumerThreadFixtures):
         with self.assert_calls_thread(cthread, _consumer, cthread._commit, offsets):
             await cthread.commit(offsets)
 
+    @pytest.mark.asyncio
+    async def test_refresh_commit(self, *, cthread, _consumer):
+        offsets = {TP1: 100}
+        with self.assert_calls_thread(
+            cthread, _consumer, cthread._refresh_commit, offsets
+        ):
+            await cthread.refresh_commit(offsets)
+
+    @pytest.mark.asyncio
+    async def test__refresh_commit(self, *, cthread, _consumer):
+        cthread._consumer = _consumer
+        cthread.assignment = Mock(return_value={TP1})
+        cthread.app.conf.broker_commit_async = True
+        cthread.app.conf.broker_commit_linger = 10.0
+        assert await cthread._refresh_commit({TP1: 1001, TP2: 2002})
+
+        _consumer.commit.assert_called_once_with(
+            {TP1: OffsetAndMetadata(1001, "")},
+        )
+        assert TP1 not in cthread.tp_last_committed_at
+        assert cthread._commit_flush_handle is None
+
+    @pytest.mark.asyncio
+    async def test__refresh_commit__unassigned(self, *, cthread, _consumer):
+        cthread._consumer = _consumer
+        cthread.assignment = Mock(return_value=set())
+        assert not await cthread._refresh_commit({TP1: 1001})
+        _consumer.commit.assert_not_called()
+
     @pytest.mark.skip("Needs fixing")
     @pytest.mark.asyncio
     async def test__commit(self, *, cthread, _consumer):
@@ -1066,6 +1279,100 @@ class Test_AIOKafkaConsumerThread(AIOKafkaConsumerThreadFixtures):
         cthread.crash.assert_called_once_with(exc)
         cthread.supervisor.wakeup.assert_called_once()
 
+    @pytest.mark.asyncio
+    async def test__commit__skips_unassigned(self, *, cthread, _consumer):
+        cthread._consumer = _consumer
+        cthread.assignment = Mock(return_value={TP1})
+        assert await cthread._commit({TP1: 1001, TP2: 2002})
+
+        cthread.assignment.assert_called_once_with()
+        _consumer.commit.assert_called_once_with(
+            {TP1: OffsetAndMetadata(1001, "")},
+        )
+        assert TP2 not in cthread.tp_last_committed_at
+
+    @pytest.mark.asyncio
+    async def test__commit__reuses_aiokafka_tps(self, *, cthread, _consumer):
+        cthread._consumer = _consumer
+        cthread.assignment = Mock(return_value={TP1})
+        aiotp = cthread._aiokafka_tp(TP1)
+        await cthread._commit({TP1: 1001})
+
+        (offsets,), _ = _consumer.commit.call_args
+        assert next(iter(offsets)) is aiotp
+
+    @pytest.mark.asyncio
+    async def test__commit__async(self, *, cthread, _consumer):
+        cthread._consumer = _consumer
+        cthread.assignment = Mock(return_value={TP1})
+        cthread.app.conf.broker_commit_async = True
+        assert await cthread._commit({TP1: 1001})
+        assert cthread._commit_tasks
+        await asyncio.gather(*cthread._commit_tasks)
+
+        _consumer.commit.assert_called_once_with(
+            {TP1: OffsetAndMetadata(1001, "")},
+        )
+        assert not cthread._commit_tasks
+        assert TP1 in cthread.tp_last_committed_at
+
+    @pytest.mark.asyncio
+    async def test__commit__async_error(self, *, cthread, _consumer):
+        cthread._consumer = _consumer
+        cthread.assignment = Mock(return_value={TP1})
+        cthread.app.conf.broker_commit_async = True
+        exc = _consumer.commit.side_effect = IllegalStateError("xx")
+        cthread.crash = AsyncMock()
+        assert await cthread._commit({TP1: 1001})
+        await asyncio.gather(*cthread._commit_tasks)
+
+        cthread.crash.assert_called_once_with(exc)
+
+    @pytest.mark.asyncio
+    async def test__commit__linger(self, *, cthread, _consumer, consumer):
+        cthread._consumer = _consumer
+        cthread.assignment = Mock(return_value={TP1, TP2})
+        cthread.app.conf.broker_commit_async = True
+        cthread.app.conf.broker_commit_linger = 10.0
+        consumer._thread.commit = cthread._commit
+        consumer.assignment = Mock(return_value={TP1, TP2})
+        consumer.app.producer.flush = AsyncMock()
+        consumer.app.tables.on_commit = Mock()
+        consumer._filter_tps_with_pending_acks = Mock(return_value=[TP1, TP2])
+        consumer._filter_committable_offsets = Mock(
+            side_effect=[{TP1: 1000, TP2: 30}, {TP1: 1001}],
+        )
+        # Consumer.commit() waits for one commit to finish before the next.
+        assert await consumer.commit()
+        assert await consumer.commit()
+        _consumer.commit.assert_not_called()
+
+        cthread._commit_flush_handle.cancel()
+        cthread._flush_commits()
+        await asyncio.gather(*cthread._commit_tasks)
+        _consumer.commit.assert_called_once_with(
+            {TP1: OffsetAndMetadata(1001, ""), TP2: OffsetAndMetadata(30, "")},
+        )
+        assert not cthread._pending_commit_offsets
+
+    @pytest.mark.asyncio
+    async def test__commit__linger_sync(self, *, cthread, _consumer):
+        cthread._consumer = _consumer
+        cthread.assignment = Mock(return_value={TP1})
+        cthread.app.conf.broker_commit_linger = 10.0
+        assert await cthread._commit({TP1: 1001})
+
+        _consumer.commit.assert_called_once_with(
+            {TP1: OffsetAndMetadata(1001, "")},
+        )
+        assert cthread._commit_flush_handle is None
+
+    def test__flush_commits__nothing_pending(self, *, cthread, _consumer):
+        cthread._consumer = _consumer
+        cthread._commit_async = Mock()
+        cthread._flush_commits()
+        cthread._commit_async.assert_not_called()
+
     @pytest.mark.asyncio
     async def test_position(self, *, cthread, _consumer):
         with self.assert_calls_thread(cthread, _consumer, _consumer.position, TP1):
@@ -1167,9 +1474,23 @@ class Test_AIOKafkaConsumerThread(AIOKafkaConsumerThreadFixtures):
     async def test__highwaters__in_transaction(self, *, cthread, _consumer):
         cthread.consumer.in_transaction = True
         cthread._consumer = _consumer
+        assignment = _consumer._fetcher._subscriptions.subscription.assignment
+        assert await cthread._highwaters([TP1]) == {
+            TP1: assignment.state_value.return_value.lso,
+        }
+        assert assignment.state_value.call_args[0][0] is cthread._aiokafka_tp(TP1)
+        _consumer.last_stable_offset.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test__highwaters__in_transaction__no_state(self, *, cthread, _consumer):
+        cthread.consumer.in_transaction = True
+        cthread._consumer = _consumer
+        assignment = _consumer._fetcher._subscriptions.subscription.assignment
+        assignment.state_value.return_value = None
         assert await cthread._highwaters([TP1]) == {
             TP1: _consumer.last_stable_offset.return_value,
         }
+        _consumer.last_stable_offset.assert_called_once_with(TP1)
 
     def test__ensure_consumer(self, *, cthread, _consumer):
         cthread._consumer = _consumer
@@ -1193,6 +1514,46 @@ class Test_AIOKafkaConsumerThread(AIOKafkaConsumerThreadFixtures):
         ):
             await cthread.getmany(active_partitions, timeout)
 
+    @pytest.mark.asyncio
+    async def test_getmany__adaptive_max_records(self, *, cthread, _consumer):
+        cthread.max_records_target_latency = 1.0
+        cthread._consumer = _consumer
+        _consumer._max_poll_records = 1000
+        cthread._adapt_max_records = Mock(return_value=100)
+        cthread.call_thread = AsyncMock(return_value={TP1: [1, 2], TP2: [3]})
+        await cthread.getmany({TP1, TP2}, 1.0)
+        cthread.call_thread.assert_called_once_with(
+            cthread._fetch_records,
+            _consumer,
+            {TP1, TP2},
+            timeout=1.0,
+            max_records=100,
+        )
+        assert cthread._last_batch_size == 3
+        assert cthread._last_batch_returned_at is not None
+
+    def test__adapt_max_records(self, *, cthread):
+        cthread.max_records_target_latency = 1.0
+        # no batch handled yet
+        assert cthread._adapt_max_records(1000, 10.0) == 1000
+        # 100 records took 2 seconds to hand over
+        cthread._last_batch_size = 100
+        cthread._last_batch_returned_at = 8.0
+        assert cthread._adapt_max_records(1000, 10.0) == 50
+        # batch handled fast: back up to the ceiling
+        cthread._record_latency = 0.0001
+        cthread._last_batch_returned_at = 9.99
+        assert cthread._adapt_max_records(1000, 10.0) == 1000
+
+    def test__adapt_max_records__bounds(self, *, cthread):
+        cthread.max_records_target_latency = 0.001
+        cthread._last_batch_size = 10
+        cthread._last_batch_returned_at = 0.0
+        assert cthread._adapt_max_records(1000, 10.0) == (
+            cthread.min_adaptive_max_records
+        )
+        assert cthread._adapt_max_records(5, 10.0) == 5
+
     @pytest.mark.asyncio
     async def test__fetch_records__flow_inactive(self, *, cthread, _consumer):
         cthread.consumer.flow_active = False
@@ -1216,7 +1577,8 @@ class Test_AIOKafkaConsumerThread(AIOKafkaConsumerThreadFixtures):
         _consumer._closed = False
         fetcher = _consumer._fetcher
         fetcher._closed = False
-        fetcher._subscriptions.fetch_context = MagicMock()
+        fetcher._subscriptions._fetch_count = 0
+        fetcher._subscriptions._last_fetch_ended = 0.0
         fetcher.fetched_records = AsyncMock()
         ret = await cthread._fetch_records(
             _consumer, {TP1}, timeout=312.3, max_records=1000
@@ -1227,6 +1589,19 @@ class Test_AIOKafkaConsumerThread(AIOKafkaConsumerThreadFixtures):
             timeout=312.3,
             max_records=1000,
         )
+        assert fetcher._subscriptions._fetch_count == 0
+        assert fetcher._subscriptions._last_fetch_ended > 0.0
+
+    @pytest.mark.asyncio
+    async def test__fetch_records__restores_fetch_count(self, *, cthread, _consumer):
+        _consumer._closed = False
+        fetcher = _consumer._fetcher
+        fetcher._closed = False
+        fetcher._subscriptions._fetch_count = 0
+        fetcher.fetched_records = AsyncMock(side_effect=asyncio.CancelledError())
+        with pytest.raises(asyncio.CancelledError):
+            await cthread._fetch_records(_consumer, {TP1})
+        assert fetcher._subscriptions._fetch_count == 0
 
     @pytest.mark.asyncio
     async def test_create_topic(self, *, cthread, _consumer):
@@ -1307,6 +1682,27 @@ class Test_AIOKafkaConsumerThread(AIOKafkaConsumerThreadFixtures):
         metadata.partitions_for_topic.return_value = None
 
         assert cthread.key_partition("topic", "k", None) is None
+        assert "topic" not in cthread._partitions_cache
+
+    def test_key_partition__caches_partitions(self, *, cthread, _consumer):
+        cthread._consumer = _consumer
+        cthread._partitioner = Mock(name="partitioner")
+        metadata = _consumer._client.cluster
+        metadata.partitions_for_topic.return_value = [1, 2, 3]
+        metadata.available_partitions_for_topic.return_value = [2, 3]
+
+        cthread.key_partition("topic", "k", None)
+        cthread.key_partition("topic", "k2", None)
+        metadata.partitions_for_topic.assert_called_once_with("topic")
+        assert cthread._partitioner.call_args_list == [
+            call("k", [1, 2, 3], [2, 3]),
+            call("k2", [1, 2, 3], [2, 3]),
+        ]
+
+        metadata.available_partitions_for_topic.return_value = [3]
+        cthread._on_metadata_change(metadata)
+        cthread.key_partition("topic", "k", None)
+        cthread._partitioner.assert_called_with("k", [1, 2, 3], [3])
 
     @contextmanager
     def assert_calls_thread(self, cthread, _consumer, method, *args, **kwargs):
@@ -1330,11 +1726,6 @@ class ProducerBaseTest:
         producer = Producer(app.transport)
         producer._new_producer = Mock(return_value=_producer)
         producer._producer = _producer
-
-        # I can't figure out what is setting a value for this,
-        # so we're clearing out the dict after creation
-        producer._transaction_producers = {}
-
         return producer
 
     @pytest.fixture()
@@ -1457,6 +1848,27 @@ class TestProducer(ProducerBaseTest):
         _producer1.commit_transaction.assert_called_once()
         _producer2.commit_transaction.assert_called_once()
 
+    @pytest.mark.asyncio
+    async def test_commit_transactions__raises_after_all(
+        self, *, producer, _producer_call
+    ):
+        _producer1 = _producer_call()
+        _producer2 = _producer_call()
+        _producer1.commit_transaction.side_effect = ProducerFenced()
+        producer._new_producer = Mock(return_value=_producer1)
+        await producer.begin_transaction("t1")
+        producer._new_producer = Mock(return_value=_producer2)
+        await producer.begin_transaction("t2")
+        tid_to_offset_map = {"t1": {TP1: 1001}, "t2": {TP2: 2002}}
+
+        with pytest.raises(ProducerFenced):
+            await producer.commit_transactions(
+                tid_to_offset_map, "group_id", start_new_transaction=True
+            )
+
+        _producer2.commit_transaction.assert_called_once()
+        assert _producer2.begin_transaction.call_count == 2
+
     def test__settings_extra(self, *, producer, app):
         app.in_transaction = True
         assert producer._settings_extra() == {
@@ -1540,6 +1952,14 @@ class TestProducer(ProducerBaseTest):
         p = producer._new_producer()
         assert isinstance(p, aiokafka.AIOKafkaProducer)
 
+    def test__settings_base(self, *, producer):
+        producer._settings_default = Mock(return_value={"a": 1, "b": 2})
+        producer._settings_auth = Mock(return_value={"b": 3})
+        assert producer._settings_base == {"a": 1, "b": 3}
+        assert producer._settings_base is producer._settings_base
+        producer._settings_default.assert_called_once_with()
+        producer._settings_auth.assert_called_once_with()
+
     def test__producer_type(self, *, producer, app):
         assert producer._producer_type is aiokafka.AIOKafkaProducer
 
@@ -1598,6 +2018,15 @@ class TestProducer(ProducerBaseTest):
         producer._new_producer.assert_called_once_with()
         producer.beacon.add.assert_called_with(_producer)
         _producer.start.assert_called_once_with()
+        assert producer._inflight is None
+
+    @pytest.mark.conf(producer_max_inflight_messages=10)
+    @pytest.mark.asyncio
+    async def test_on_start__max_inflight(self, *, producer):
+        producer._new_producer = Mock(return_value=Mock(start=AsyncMock()))
+        producer.beacon = Mock()
+        await producer.on_start()
+        assert isinstance(producer._inflight, asyncio.Semaphore)
 
     @pytest.mark.asyncio
     async def test_on_stop(self, *, producer, _producer):
@@ -1631,6 +2060,116 @@ class TestProducer(ProducerBaseTest):
             headers=[("foo", "bar")],
         )
 
+    @pytest.mark.asyncio
+    async def test_send__no_produce_message_receivers(self, producer, _producer):
+        producer._produce_message_receivers = set()
+        producer._produce_message_filter_receivers = {}
+        producer._send_on_produce_message = Mock()
+        await producer.send("topic", "k", "v", 3, 100, None)
+        producer._send_on_produce_message.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_send__produce_message_receivers(self, producer, _producer):
+        producer._produce_message_receivers = {Mock()}
+        producer._send_on_produce_message = Mock()
+        await producer.send("topic", "k", "v", 3, 100, None)
+        producer._send_on_produce_message.assert_called_once_with(
+            key="k",
+            value="v",
+            partition=3,
+            timestamp=100,
+            headers=None,
+        )
+
+    @pytest.mark.asyncio
+    async def test_send__produce_message_receivers_unknown(self, producer, _producer):
+        producer._produce_message_receivers = None
+        producer._produce_message_filter_receivers = None
+        producer._send_on_produce_message = Mock()
+        await producer.send("topic", "k", "v", 3, 100, None)
+        producer._send_on_produce_message.assert_called_once()
+
+    def test__post_init__signal_without_receivers(self, *, app):
+        app.on_produce_message = Mock(spec=["send"])
+        producer = Producer(app.transport)
+        assert producer._produce_message_receivers is None
+        assert producer._produce_message_filter_receivers is None
+        assert producer._send_on_produce_message is app.on_produce_message.send
+
+    @pytest.mark.asyncio
+    async def test_send__list_headers(self, producer, _producer):
+        headers = [("foo", "bar")]
+        await producer.begin_transaction("tid")
+        await producer.send(
+            "topic",
+            "k",
+            "v",
+            3,
+            100,
+            headers,
+            transactional_id="tid",
+        )
+        assert _producer.send.call_args[1]["headers"] is headers
+
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize(
+        "timestamp,timestamp_ms",
+        [(None, None), (100, 100000), (100.5, 100500), (1.0005, 1000)],
+    )
+    async def test_send__timestamp_ms(
+        self, producer, _producer, timestamp, timestamp_ms
+    ):
+        await producer.send("topic", "k", "v", 3, timestamp, None)
+        sent_timestamp_ms = _producer.send.call_args[1]["timestamp_ms"]
+        assert sent_timestamp_ms == timestamp_ms
+        assert type(sent_timestamp_ms) is type(timestamp_ms)
+
+    @pytest.mark.asyncio
+    async def test_send__waits_for_commit(self, producer, _producer):
+        await producer.begin_transaction("tid")
+        committing = asyncio.Event()
+        resume_commit = asyncio.Event()
+
+        async def send_offsets_to_transaction(offsets, group_id):
+            committing.set()
+            await resume_commit.wait()
+
+        _producer.send_offsets_to_transaction.side_effect = send_offsets_to_transaction
+        commit = asyncio.ensure_future(
+            producer.commit_transactions({"tid": {TP1: 1}}, "group_id")
+        )
+        await committing.wait()
+        send = asyncio.ensure_future(
+            producer.send("topic", "k", "v", 3, 100, None, transactional_id="tid")
+        )
+        await asyncio.sleep(0)
+        _producer.send.assert_not_called()
+
+        resume_commit.set()
+        await commit
+        await send
+        _producer.send.assert_called_once()
+        _producer.commit_transaction.assert_called_once_with()
+
+    @pytest.mark.asyncio
+    async def test_send__max_inflight(self, producer, _producer):
+        producer._inflight = asyncio.Semaphore(1)
+        fut = asyncio.Future()
+        _producer.send.return_value = fut
+        assert await producer.send("topic", "k", "v", 3, 100, None) is fut
+        assert producer._inflight.locked()
+        fut.set_result(None)
+        await asyncio.sleep(0)
+        assert not producer._inflight.locked()
+
+    @pytest.mark.asyncio
+    async def test_send__max_inflight__error(self, producer, _producer):
+        producer._inflight = asyncio.Semaphore(1)
+        _producer.send.side_effect = KafkaError()
+        with pytest.raises(ProducerSendError):
+            await producer.send("topic", "k", "v", 3, 100, None)
+        assert not producer._inflight.locked()
+
     @pytest.mark.asyncio
     @pytest.mark.conf(producer_api_version="0.10")
     async def test_send__request_no_headers(self, producer, _producer):
@@ -1752,6 +2291,28 @@ class TestProducer(ProducerBaseTest):
                 None,
             )
 
+    @pytest.mark.asyncio
+    async def test_send__plain(self, producer, _producer):
+        producer._trn_locks = MagicMock(name="_trn_locks")
+        ret = await producer.send("topic", "k", "v", 3, None, None)
+        assert ret is _producer.send.return_value
+        _producer.send.assert_called_once_with(
+            "topic",
+            "v",
+            key="k",
+            partition=3,
+            timestamp_ms=None,
+            headers=None,
+        )
+        producer._trn_locks.__getitem__.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_send__passes_buffers_through(self, producer, _producer):
+        key, value = memoryview(b"k"), bytearray(b"v")
+        await producer.send("topic", key, value, 3, None, None)
+        assert _producer.send.call_args[0][1] is value
+        assert _producer.send.call_args[1]["key"] is key
+
     @pytest.mark.asyncio
     async def test_send__trn_KafkaError(self, producer, _producer):
         _producer.send.side_effect = KafkaError()
@@ -1858,6 +2419,172 @@ class TestThreadedProducer(ProducerBaseTest):
         finally:
             await threaded_producer.stop()
 
+    @pytest.mark.asyncio
+    async def test_on_thread_stop__push_events_failed(
+        self,
+        *,
+        threaded_producer: ThreadedProducer,
+        mocked_producer: Mock,
+    ):
+        async def push_events():
+            raise ProducerSendError("failed")
+
+        threaded_producer.thread_loop = asyncio.get_running_loop()
+        threaded_producer._producer = mocked_producer
+        threaded_producer.event_queue = asyncio.Queue()
+        threaded_producer._push_events_task = asyncio.ensure_future(push_events())
+        with patch(TESTED_MODULE + ".logger") as logger:
+            await threaded_producer.on_thread_stop()
+        logger.exception.assert_called_once()
+        mocked_producer.flush.assert_called_once_with()
+        mocked_producer.stop.assert_called_once_with()
+
+    @pytest.mark.asyncio
+    async def test_on_thread_stop__waits_on_thread_loop(
+        self,
+        *,
+        threaded_producer: ThreadedProducer,
+        mocked_producer: Mock,
+    ):
+        thread_loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=thread_loop.run_forever, daemon=True)
+        thread.start()
+        try:
+            threaded_producer.thread_loop = thread_loop
+            threaded_producer._producer = mocked_producer
+            threaded_producer.event_queue = asyncio.Queue()
+            threaded_producer.publish_message = AsyncMock()
+            threaded_producer._push_events_task = asyncio.run_coroutine_threadsafe(
+                self._create_task(threaded_producer.push_events()), thread_loop
+            ).result(timeout=5)
+            await threaded_producer.on_thread_stop()
+            assert threaded_producer._push_events_task.done()
+            mocked_producer.stop.assert_called_once_with()
+        finally:
+            thread_loop.call_soon_threadsafe(thread_loop.stop)
+            thread.join(timeout=5)
+            thread_loop.close()
+
+    @pytest.mark.asyncio
+    async def test_on_thread_stop__push_events_timeout(
+        self,
+        *,
+        threaded_producer: ThreadedProducer,
+        mocked_producer: Mock,
+    ):
+        threaded_producer.thread_loop = asyncio.get_running_loop()
+        threaded_producer.shutdown_timeout = 0.01
+        threaded_producer._producer = mocked_producer
+        threaded_producer.event_queue = asyncio.Queue()
+        push_events_task = threaded_producer._push_events_task = asyncio.ensure_future(
+            asyncio.sleep(10)
+        )
+        with patch(TESTED_MODULE + ".logger") as logger:
+            await threaded_producer.on_thread_stop()
+        logger.warning.assert_called_once()
+        assert push_events_task.cancelled()
+        mocked_producer.stop.assert_called_once_with()
+
+    @staticmethod
+    async def _create_task(coro):
+        return asyncio.ensure_future(coro)
+
+    @pytest.mark.asyncio
+    async def test_flush(
+        self,
+        *,
+        threaded_producer: ThreadedProducer,
+        mocked_producer: Mock,
+    ):
+        threaded_producer._producer = mocked_producer
+        threaded_producer.event_queue = asyncio.Queue()
+        threaded_producer.publish_message = AsyncMock()
+        events = [Mock(name="event1"), Mock(name="event2"), Mock(name="event3")]
+        for event in events:
+            threaded_producer.event_queue.put_nowait(event)
+        await threaded_producer.flush()
+        threaded_producer.publish_message.assert_has_calls(
+            [call(event) for event in events]
+        )
+        assert threaded_producer.event_queue.empty()
+        mocked_producer.flush.assert_called_once_with()
+
+    @pytest.mark.asyncio
+    async def test_flush__keeps_stop_sentinel(
+        self,
+        *,
+        threaded_producer: ThreadedProducer,
+        mocked_producer: Mock,
+    ):
+        threaded_producer._producer = mocked_producer
+        threaded_producer.event_queue = asyncio.Queue()
+        threaded_producer.publish_message = AsyncMock()
+        threaded_producer.event_queue.put_nowait(mod._STOP)
+        await threaded_producer.flush()
+        threaded_producer.publish_message.assert_not_called()
+        assert threaded_producer.event_queue.get_nowait() is mod._STOP
+
+    @pytest.mark.asyncio
+    async def test__autotune_linger(self, *, threaded_producer: ThreadedProducer):
+        producer = threaded_producer._producer = aiokafka.AIOKafkaProducer(
+            linger_ms=100,
+        )
+        threaded_producer.event_queue = asyncio.Queue()
+        threaded_producer.autotune_queue_high = 4
+        threaded_producer.stopped = False
+        for _ in range(3):
+            threaded_producer.event_queue.put_nowait(Mock())
+
+        async def sleep(secs):
+            threaded_producer.stopped = True
+
+        lingerer = mod._producer_lingerer(producer)
+        assert lingerer in (producer._message_accumulator, producer._sender)
+        with patch("asyncio.sleep", side_effect=sleep):
+            await threaded_producer._autotune_linger()
+        assert lingerer._linger_time == pytest.approx(0.025)
+
+    def test__autotune_linger__supported_aiokafka(self):
+        # producer_linger_autotune writes private aiokafka attributes,
+        # so check _producer_lingerer again before supporting a new version.
+        version = tuple(int(part) for part in aiokafka.__version__.split(".")[:2])
+        assert (0, 10) <= version <= (0, 14)
+
+    @pytest.mark.parametrize("attr", ["_message_accumulator", "_sender"])
+    def test__producer_lingerer(self, attr):
+        producer = Mock(_message_accumulator=Mock(spec=[]), _sender=Mock(spec=[]))
+        lingerer = Mock(_linger_time=0.1)
+        setattr(producer, attr, lingerer)
+        assert mod._producer_lingerer(producer) is lingerer
+
+    @pytest.mark.asyncio
+    async def test__autotune_linger__unsupported(
+        self, *, threaded_producer: ThreadedProducer
+    ):
+        threaded_producer._producer = Mock(
+            _message_accumulator=Mock(spec=[]),
+            _sender=Mock(spec=[]),
+        )
+        threaded_producer.stopped = False
+        with patch("asyncio.sleep", AsyncMock()) as sleep:
+            await threaded_producer._autotune_linger()
+        sleep.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_push_events(self, *, threaded_producer: ThreadedProducer):
+        threaded_producer.event_queue = asyncio.Queue()
+        threaded_producer.publish_message = AsyncMock()
+        events = [Mock(name="event1"), Mock(name="event2")]
+        trailing = Mock(name="trailing")
+        for event in events:
+            threaded_producer.event_queue.put_nowait(event)
+        threaded_producer.event_queue.put_nowait(mod._STOP)
+        threaded_producer.event_queue.put_nowait(trailing)
+        await asyncio.wait_for(threaded_producer.push_events(), timeout=1.0)
+        assert threaded_producer.publish_message.call_args_list == [
+            call(event) for event in [*events, trailing]
+        ]
+
     @pytest.mark.asyncio
     async def test_publish_message(
         self,
@@ -1921,11 +2648,16 @@ class TestThreadedProducer(ProducerBaseTest):
 class TestTransport:
     @pytest.fixture()
     def transport(self, *, app):
-        return Transport(url=["aiokafka://"], app=app)
+        return Transport(url=[URL("aiokafka://")], app=app)
 
     def test_constructor(self, *, transport):
         assert transport._topic_waiters == {}
 
+    def test_bootstrap_servers(self, *, transport):
+        servers = transport.bootstrap_servers
+        assert servers == ["127.0.0.1:9092"]
+        assert transport.bootstrap_servers is servers
+
     def test__topic_config(self, *, transport):
         assert transport._topic_config() == {}
 
@@ -2006,6 +2738,36 @@ class TestTransport:
                 )
             assert "foo" not in transport._topic_waiters
 
+    @pytest.mark.asyncio
+    async def test__get_controller_node(self, *, transport):
+        client = Mock(name="client")
+        client.cluster.brokers.return_value = {Mock(nodeId=1)}
+        owner = Mock(name="owner")
+        owner.wait = AsyncMock(
+            return_value=Mock(stopped=False, result=Mock(controller_id=3))
+        )
+        assert await transport._get_controller_node(owner, client) == 3
+        assert await transport._get_controller_node(owner, client) == 3
+        client.send.assert_called_once_with(1, mod._METADATA_REQUEST_NO_TOPICS)
+
+        transport._controller_node_expires = 0.0
+        assert await transport._get_controller_node(owner, client) == 3
+        assert client.send.call_count == 2
+
+    @pytest.mark.asyncio
+    async def test__get_controller_node__no_brokers(self, *, transport):
+        client = Mock(name="client")
+        client.cluster.brokers.return_value = set()
+        with pytest.raises(Exception, match="Controller node not found"):
+            await transport._get_controller_node(Mock(name="owner"), client)
+
+    @pytest.mark.asyncio
+    async def test__get_controller_node__not_connected(self, *, transport):
+        client = Mock(name="client")
+        client.cluster.brokers.return_value = {Mock(nodeId=None)}
+        with pytest.raises(NotReady):
+            await transport._get_controller_node(Mock(name="owner"), client)
+
 
 @pytest.mark.parametrize(
     "credentials,ssl_context,expected",
@@ -2073,12 +2835,90 @@ def test_credentials_to_aiokafka(credentials, ssl_context, expected):
     assert credentials_to_aiokafka_auth(credentials, ssl_context) == expected
 
 
+def test_credentials_to_aiokafka__plaintext_is_copied():
+    first = credentials_to_aiokafka_auth(None, None)
+    first["security_protocol"] = "SSL"
+    assert credentials_to_aiokafka_auth(None, None) == {
+        "security_protocol": "PLAINTEXT",
+    }
+    assert mod._PLAINTEXT_AUTH == {"security_protocol": "PLAINTEXT"}
+
+
+def test_credentials_to_aiokafka__subclass():
+    class MySASLCredentials(auth.SASLCredentials): ...
+
+    credentials = MySASLCredentials(username="usr", password="pwd")
+    assert credentials_to_aiokafka_auth(credentials) == {
+        "security_protocol": "SASL_PLAINTEXT",
+        "sasl_mechanism": "PLAIN",
+        "sasl_plain_username": "usr",
+        "sasl_plain_password": "pwd",
+        "ssl_context": None,
+    }
+
+
 def test_credentials_to_aiokafka__invalid():
     with pytest.raises(ImproperlyConfigured):
         credentials_to_aiokafka_auth(object())
 
 
+def test_ensure_aiokafka_TP():
+    tp = TopicPartition("foo", 0)
+    assert ensure_aiokafka_TP(tp) is tp
+    actual = ensure_aiokafka_TP(TP(topic="foo", partition=0))
+    assert actual == tp
+    assert type(actual) is TopicPartition
+
+
 def test_ensure_aiokafka_TPset():
     actual = ensure_aiokafka_TPset({TP(topic="foo", partition=0)})
     assert actual == {TopicPartition("foo", 0)}
     assert all(isinstance(tp, TopicPartition) for tp in actual)
+
+
+@pytest.mark.parametrize("factory", [set, frozenset])
+def test_ensure_aiokafka_TPset__already_converted(factory):
+    tps = factory({TopicPartition("foo", 0), TopicPartition("foo", 1)})
+    actual = ensure_aiokafka_TPset(tps)
+    assert actual == tps
+    assert actual is not tps
+    assert type(actual) is set
+
+
+def test_ensure_aiokafka_TPset__empty():
+    tps = set()
+    actual = ensure_aiokafka_TPset(tps)
+    assert actual == set()
+    assert actual is not tps
+
+
+def test_ensure_aiokafka_TPset__iterable():
+    tps = [TP(topic="foo", partition=0), TopicPartition("foo", 1)]
+    actual = ensure_aiokafka_TPset(iter(tps))
+    assert actual == {TopicPartition("foo", 0), TopicPartition("foo", 1)}
+    assert all(type(tp) is TopicPartition for tp in actual)
+
+
+def test_server_list():
+    urls = [URL("kafka://[::1]:9093"), URL("kafka://foo"), URL("kafka://")]
+    assert server_list(urls, 9092) == [
+        "[::1]:9093",
+        "foo:9092",
+        "127.0.0.1:9092",
+    ]
+
+
+@pytest.mark.parametrize("key", [b"", b"a", b"ab", b"abc", b"abcd", b"key-12345678"])
+def test_cython_partitioner(key):
+    cpartitioner = pytest.importorskip("faust.transport._cython.partitioner")
+    partitions = list(range(12))
+    expected = aiokafka_partitioner.DefaultPartitioner()(key, partitions, partitions)
+    assert cpartitioner.murmur2(key) == aiokafka_partitioner.murmur2(key)
+    assert cpartitioner.DefaultPartitioner()(key, partitions, partitions) == expected
+
+
+def test_cython_partitioner__no_key():
+    cpartitioner = pytest.importorskip("faust.transport._cython.partitioner")
+    partitioner = cpartitioner.DefaultPartitioner()
+    assert partitioner(None, [1, 2, 3], [2]) == 2
+    assert partitioner(None, [1], []) == 1
@@ -528,6 +528,29 @@ class TestConsumer:
             (TP2, "G"),
         ]
 
+    @pytest.mark.asyncio
+    async def test_getmany__converts_yielded_records_only(self, *, consumer):
+        converted = []
+
+        def to_message(tp, record):
+            converted.append(record)
+            return record
+
+        consumer._to_message = to_message
+        self._setup_records(
+            consumer,
+            active_partitions={TP1},
+            records={
+                TP1: ["A", "B", "C"],
+                TP3: ["H", "I", "J"],
+            },
+        )
+        consumer.flow_active = True
+        it = consumer.getmany(1.0)
+        assert await it.__anext__() == (TP1, "A")
+        await it.aclose()
+        assert converted == ["A"]
+
     @pytest.mark.asyncio
     async def test_getmany_buffered(self, *, consumer):
         def to_message(tp, record):
@@ -1148,6 +1171,62 @@ class TestConsumer:
         )
         consumer.commit.assert_called_once_with()
 
+    @pytest.mark.asyncio
+    async def test_refresh_committed_offsets(self, *, consumer):
+        consumer.in_transaction = False
+        consumer._refresh_commit = AsyncMock(name="_refresh_commit")
+        consumer._commit = AsyncMock(name="_commit")
+        consumer.assignment = Mock(return_value={TP1, TP2})
+        consumer._committed_offset.update({TP1: 10, TP2: None, TP3: 30})
+
+        assert await consumer.refresh_committed_offsets()
+        consumer._refresh_commit.assert_called_once_with({TP1: 10})
+        consumer._commit.assert_not_called()
+        assert consumer._commit_fut is None
+        assert not consumer._refreshing_commits
+
+    @pytest.mark.asyncio
+    async def test_refresh_committed_offsets__does_not_block_commit(self, *, consumer):
+        consumer.in_transaction = False
+        consumer.assignment = Mock(return_value={TP1})
+        consumer._committed_offset[TP1] = 10
+        consumer.force_commit = AsyncMock(name="force_commit")
+
+        async def _refresh_commit(offsets):
+            # a regular commit arriving while the refresh is in flight
+            assert await consumer.commit() is consumer.force_commit.return_value
+            assert not await consumer.refresh_committed_offsets()
+            return True
+
+        consumer._refresh_commit = _refresh_commit
+        assert await consumer.refresh_committed_offsets()
+        consumer.force_commit.assert_called_once()
+
+    @pytest.mark.asyncio
+    async def test_refresh_committed_offsets__commit_in_progress(self, *, consumer):
+        consumer.in_transaction = False
+        consumer._refresh_commit = AsyncMock(name="_refresh_commit")
+        consumer._committed_offset[TP1] = 10
+        consumer._commit_fut = asyncio.Future()
+
+        assert not await consumer.refresh_committed_offsets()
+        consumer._refresh_commit.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_refresh_committed_offsets__in_transaction(self, *, consumer):
+        consumer.in_transaction = True
+        consumer._refresh_commit = AsyncMock(name="_refresh_commit")
+        consumer._committed_offset[TP1] = 10
+
+        assert not await consumer.refresh_committed_offsets()
+        consumer._refresh_commit.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test__refresh_commit(self, *, consumer):
+        consumer._commit = AsyncMock(name="_commit")
+        assert await consumer._refresh_commit({TP1: 10})
+        consumer._commit.assert_called_once_with({TP1: 10})
+
     def test_close(self, *, consumer):
         consumer.close()
 
@@ -1195,6 +1274,12 @@ class Test_ConsumerThread:
             {TP1, TP2},
         )
 
+    @pytest.mark.asyncio
+    async def test_refresh_commit(self, *, thread):
+        thread.commit = AsyncMock(name="commit")
+        assert await thread.refresh_commit({TP1: 10})
+        thread.commit.assert_called_once_with({TP1: 10})
+
     @pytest.mark.asyncio
     async def test_on_partitions_assigned(self, *, thread, consumer):
         gen_id = 1
@@ -1364,6 +1449,13 @@ class Test_ThreadDelegateConsumer:
         )
         assert ret is consumer._thread.commit.return_value
 
+    @pytest.mark.asyncio
+    async def test__refresh_commit(self, *, consumer):
+        consumer._thread.refresh_commit = AsyncMock(name="refresh_commit")
+        ret = await consumer._refresh_commit({TP1: 301})
+        consumer._thread.refresh_commit.assert_called_once_with({TP1: 301})
+        assert ret is consumer._thread.refresh_commit.return_value
+
     @pytest.mark.asyncio
     async def test_maybe_wait_for_commit_to_finish(self, *, loop, consumer):
         consumer._commit_fut = None
@@ -1413,6 +1505,19 @@ class Test_ThreadDelegateConsumer:
                 ]
             )
 
+    @pytest.mark.asyncio
+    async def test_verify_all_partitions_active__yields(self, *, consumer):
+        consumer.assignment = Mock(name="assignment")
+        consumer.assignment.return_value = [TP1, TP2, TP3]
+        consumer.verify_partitions_per_yield = 2
+        consumer.verify_event_path = Mock(name="verify_event_path")
+        consumer.sleep = AsyncMock()
+
+        await consumer.verify_all_partitions_active()
+
+        assert consumer.sleep.call_count == 2
+        assert consumer.verify_event_path.call_count == 3
+
     @pytest.mark.asyncio
     async def test_verify_all_partitions_active__bail_on_sleep(self, *, consumer):
         consumer.assignment = Mock(name="assignment")